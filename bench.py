@@ -0,0 +1,319 @@
+"""
+性能测试
+生成与 sample1.xlsx 格式相同的表格 (两行表头, 计划取自生成的 auto.xlsx, 费率取自生成的费率表),
+分阶段计时: 读取表格, 合并表头, 插入新列, 逐行计算, 写入表格
+另外记录命令行的启动时间 (`main.py --help` 与 `quote.py` 计算一名员工)
+结果以 JSON 输出, 便于比较不同版本
+
+python bench.py --sizes 1000 10000 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+import pandas as pd
+
+from calculator import CostCalculator
+from handlers import (
+    AutoMapHandler,
+    ExcelHandler,
+    Instrument,
+    ResultBuffer,
+    WorkbookLoader,
+)
+
+# 表头: (第一行, 第二行), 合并后与 `ExcelHandler` 中的列名一致
+HEADERS = [
+    ("", "客户姓名"),
+    ("", "生效日期"),
+    ("", "终止日期"),
+    ("", "工资"),
+    ("", "计划"),
+    ("PCA_B", "保额"),
+    ("", "保费"),
+    ("ADD_B", "保额"),
+    ("", "保费"),
+    ("WMP-HL1", "保额"),
+    ("", "保费"),
+    ("OPD", "保额"),
+    ("", "保费"),
+    ("DEN", "保额"),
+    ("", "保费"),
+    ("TL", "保额"),
+    ("", "保费"),
+    ("HI", "保额"),
+    ("", "保费"),
+    ("AKDD", "保额"),
+]
+
+# 用于生成计划的产品名称
+PLAN_NAMES = {
+    "tl": ["定寿基础", "定寿加强", "定寿VIP"],
+    "add": ["意外基础", "意外加强", "意外VIP"],
+    "akdd": ["重疾基础", "重疾加强", "重疾VIP"],
+    "wmp": ["医疗基础", "医疗加强", "医疗比强更强", "医疗VIP"],
+    "pca": ["交通意外"],
+    "hi": ["住院津贴基础", "住院津贴加强", "住院津贴VIP"],
+}
+
+# auto.xlsx 中的列名
+AUTO_COLS = {
+    "tl": "定寿",
+    "add": "意外",
+    "akdd": "重疾",
+    "wmp": "医疗",
+    "pca": "交通意外",
+    "hi": "住院津贴",
+}
+
+# 生成的费率表
+SYNTHETIC_RATES = {
+    "pca_amount": Decimal(500000),
+    "pca_epy_rate": Decimal("0.00005"),
+    "add_mag": {1: Decimal(24), 2: Decimal(36), 3: Decimal(48)},
+    "add_basic_mag": Decimal(24),
+    "add_rate": Decimal("0.00013"),
+    "wmp_emy_cost": {
+        1: Decimal(1200),
+        3: Decimal(2500),
+        4: Decimal(3100),
+        5: Decimal(8800),
+    },
+    "wmp_emy_basic_cost": Decimal(1200),
+    "wmp_sps_cost": {
+        1: Decimal(1500),
+        3: Decimal(2900),
+        4: Decimal(3600),
+        5: Decimal(9900),
+    },
+    "wmp_chd_cost": {1: Decimal(800), 2: Decimal(1200), 3: Decimal(2500)},
+    "wmp_chd_basic_cost": Decimal(800),
+    "tl_mag": {1: Decimal(12), 2: Decimal(24), 3: Decimal(36)},
+    "tl_basic_mag": Decimal(12),
+    "tl_rate": Decimal("0.00031"),
+    "hi_basic_amount": Decimal(100),
+    "hi_rate": Decimal("0.7"),
+    "akdd_amount": {1: Decimal(100000), 2: Decimal(200000), 3: Decimal(500000)},
+    "akdd_basic_amount": Decimal(100000),
+    "akdd_rate": Decimal("0.0009"),
+}
+
+
+def generate_auto(path: str, plans: int = 30, seed: int = 0) -> list:
+    """
+    生成 auto.xlsx
+    :return: 生成的计划代码
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(plans):
+        who = rng.choice(["员工", "配偶", "子女"])
+        row = {"组合计划": f"P{i:03d}", "组合计划名称": f"{who}计划{i}"}
+        for product, col in AUTO_COLS.items():
+            # 部分计划不包含该产品
+            row[col] = (
+                f"{who}{rng.choice(PLAN_NAMES[product])}" if rng.random() < 0.9 else " "
+            )
+
+        rows.append(row)
+
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame([[None]]).to_excel(writer, sheet_name="Sheet1", index=False)
+        pd.DataFrame(rows).to_excel(writer, sheet_name="Sheet2", index=False)
+
+    return [row["组合计划"] for row in rows]
+
+
+def generate_roster(path: str, rows: int, codes: list, seed: int = 0):
+    """
+    生成与 sample1.xlsx 格式相同的表格
+    """
+    rng = random.Random(seed)
+    data = [[top for top, _ in HEADERS], [bottom for _, bottom in HEADERS]]
+    for i in range(rows):
+        month = rng.randint(1, 12)
+        row = [
+            f"员工{i}",
+            f"2021/{month:02d}/{rng.randint(1, 28):02d}",
+            "2021/12/31",
+            rng.randrange(3000, 60000, 100),
+            rng.choice(codes),
+        ]
+        for _ in range(7):
+            row.append(rng.choice([100000, 200000, 500000]))
+            row.append(round(rng.uniform(10, 500), 2))
+
+        row.append(rng.choice([100000, 200000, 500000]))
+        data.append(row)
+
+    pd.DataFrame(data).to_excel(path, header=False, index=False)
+
+
+class BenchHandler(ExcelHandler):
+    """
+    使用已读取的数据, 读取阶段单独计时
+    """
+
+    def __init__(self, df: pd.DataFrame, **kwargs):
+        self.preloaded = df
+        super().__init__(**kwargs)
+
+    def load(self) -> pd.DataFrame:
+        return self.preloaded
+
+
+def bench_size(
+    workdir: str,
+    rows: int,
+    auto_map: AutoMapHandler,
+    calculator: CostCalculator,
+    codes: list,
+) -> dict:
+    path = os.path.join(workdir, f"roster_{rows}.xlsx")
+    generate_roster(path, rows, codes)
+
+    timer = Instrument()
+    loader = WorkbookLoader()
+    header_from, header_to = 1, 2
+
+    with timer.stage("read"):
+        raw = loader.read(path, header=None)
+
+    with timer.stage("headers"):
+        headers = loader.header_handler(
+            raw.iloc[header_from - 1 : header_to].values.tolist()
+        )
+        df = raw.loc[header_to:]
+        df.columns = headers
+
+    e = BenchHandler(df, excel_path=path, auto_map=auto_map, calculator=calculator)
+    inserts = e.output_inserts()
+
+    with timer.stage("calculate"):
+        active_days, errors = e.active_days()
+        buffer = ResultBuffer([name for _, name, _ in inserts], e.amount_columns())
+        for res in e.iter_results(e.input_values(), active_days):
+            buffer.append(res)
+
+    with timer.stage("insert_columns"):
+        e.insert_results(inserts, buffer)
+
+    with timer.stage("write"):
+        e.writer.write(
+            e.df, os.path.join(workdir, f"roster_{rows}_new.xlsx"), e.amount_columns()
+        )
+
+    stages = timer.report()["stages"]
+    total = sum(stages.values())
+    return {
+        "rows": rows,
+        "stages": stages,
+        "total": round(total, 4),
+        "rows_per_second": round(rows / total, 1) if total else None,
+        "date_errors": len(errors),
+    }
+
+
+def startup_time(args: list, repeat: int = 3) -> float:
+    """
+    在新进程中运行脚本, 取 `repeat` 次中最快的一次
+    :param args: 脚本 (相对于本目录) 与参数
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, args[0])] + args[1:]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=here, capture_output=True, check=True)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return round(best, 4)
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(sizes: list) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        auto_path = os.path.join(workdir, "auto.xlsx")
+        codes = generate_auto(auto_path)
+        auto_map = AutoMapHandler(path=auto_path, cache=False)
+
+        rate_card = os.path.join(workdir, "rates.json")
+        CostCalculator.write_rates(SYNTHETIC_RATES, rate_card)
+        calculator = CostCalculator.from_file(
+            rate_card, days_of_year=ExcelHandler.days_of_year
+        )
+
+        results = [
+            bench_size(workdir, rows, auto_map, calculator, codes) for rows in sizes
+        ]
+        startup = {
+            "main_help": startup_time(["main.py", "--help"]),
+            "quote": startup_time(
+                [
+                    "quote.py",
+                    "--rates",
+                    rate_card,
+                    "--salary",
+                    "12000",
+                    "--days",
+                    "334",
+                    "--add",
+                    "员工意外VIP",
+                    "--wmp",
+                    "员工医疗加强",
+                ]
+            ),
+        }
+
+    return {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "engine": WorkbookLoader().engine,
+        "startup": startup,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="性能测试")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000, 1000000],
+        help="生成的表格行数",
+    )
+    parser.add_argument("--output", default=None, help="结果 JSON 路径, 默认输出到屏幕")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args.sizes), ensure_ascii=False, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,63 @@
-from decimal import Decimal, getcontext
-from typing import List
+import json
+import math
+from decimal import MAX_PREC, ROUND_HALF_UP, Context, Decimal, getcontext
+from typing import Callable, List, Optional, Sequence, Tuple
+
+
+class Share:
+    """
+    公司或员工一方的缴纳结果
+    result: 金额
+    formula: 计算公式, 在第一次访问时才生成
+    """
+
+    __slots__ = ("result", "_formula", "_render")
+
+    def __init__(
+        self,
+        result=0,
+        formula: Optional[str] = "0",
+        render: Callable[[], str] = None,
+    ):
+        self.result = result
+        self._formula = formula
+        self._render = render
+
+    @property
+    def formula(self) -> Optional[str]:
+        if self._render is not None:
+            self._formula = self._render()
+            self._render = None
+
+        return self._formula
+
+    def __getitem__(self, key):
+        # 兼容原先 `data["for_company"]["result"]` 的用法
+        return getattr(self, key)
+
+
+class CostResult:
+    """
+    一个产品的计算结果
+    """
+
+    __slots__ = ("for_company", "for_employee")
+
+    def __init__(self, for_company: Share = None, for_employee: Share = None):
+        self.for_company = Share() if for_company is None else for_company
+        self.for_employee = Share() if for_employee is None else for_employee
+
+    def __getitem__(self, key):
+        return getattr(self, key)
 
 
 class CostCalculator:
     """
-    计算器
-    active_days: 实际缴纳天数
+    计算器, 费率表在创建时设置一次, 同一实例可以计算整张表
+    rates: {费率名: 值}, 见 `rate_names` 与 `read_rates`
+        为 None 时不设置费率, 只适用于以类属性定义了全部费率的子类, 否则报 Missing rates
     days_of_year: 费率对应天数
+    with_formula: 是否生成计算公式, 批量计算只需要金额时可以关闭
     """
 
     class Type:
@@ -14,56 +65,210 @@ class CostCalculator:
         SPOUSE = "sps"
         CHILD = "chd"
 
+    # 费率表
+    rate_names = (
+        "pca_amount",
+        "pca_epy_rate",
+        "add_mag",
+        "add_basic_mag",
+        "add_rate",
+        "wmp_emy_cost",
+        "wmp_emy_basic_cost",
+        "wmp_sps_cost",
+        "wmp_chd_cost",
+        "wmp_chd_basic_cost",
+        "tl_mag",
+        "tl_basic_mag",
+        "tl_rate",
+        "hi_basic_amount",
+        "hi_rate",
+        "akdd_amount",
+        "akdd_basic_amount",
+        "akdd_rate",
+    )
+
     def __init__(
         self,
-        active_days: int,
+        rates: dict = None,
         days_of_year: int = 365,
+        with_formula: bool = True,
     ):
+        self.days_of_year = days_of_year
+        self.with_formula = with_formula
+
+        if rates is not None:
+            for name in self.rate_names:
+                setattr(self, name, rates.get(name))
+
+        missing = [name for name, value in self.rates().items() if value is None]
+        if missing:
+            raise ValueError(f"Missing rates: {', '.join(missing)}")
+
+        self.day_rates = self.per_day_rates()
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "CostCalculator":
+        """
+        :param path: 费率表文件, 见 `read_rates`
+        :param kwargs: 见 `CostCalculator`
+        """
+        return cls(cls.read_rates(path), **kwargs)
+
+    @staticmethod
+    def read_rates(path: str) -> dict:
+        """
+        读取 JSON 费率表, 金额与费率写为字符串以保持精度, 按等级区分的费率写为 {等级: 值}
+        {"pca_amount": "500000", "add_mag": {"1": "24", "2": "36"}, ...}
+        完整的示例 (`bench.SYNTHETIC_RATES`, 非实际费率) 见 rates.example.json, 复制为 rates.json 后修改
+        :return: {费率名: Decimal 或 {int 等级: Decimal}}
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        rates = {}
+        for name, value in data.items():
+            if isinstance(value, dict):
+                rates[name] = {int(k): Decimal(str(v)) for k, v in value.items()}
+            else:
+                rates[name] = Decimal(str(value))
+
+        return rates
+
+    @classmethod
+    def write_rates(cls, rates: dict, path: str):
+        """
+        将费率表写为 `read_rates` 可以读取的 JSON
+        """
+        data = {}
+        for name in cls.rate_names:
+            value = rates[name]
+            if isinstance(value, dict):
+                data[name] = {str(k): str(v) for k, v in value.items()}
+            else:
+                data[name] = str(value)
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def rates(self) -> dict:
+        """
+        :return: {费率名: 值}, 未设置的费率为 None
+        """
+        return {name: getattr(self, name, None) for name in self.rate_names}
+
+    def per_day_rates(self) -> dict:
+        """
+        预先计算每天的费率 (费率 / days_of_year), 每行只需再乘以天数或 工资 * 天数
+        运算顺序与逐项计算相同, 结果与在每行中计算完全一致
+        :return: {名称: Decimal 或 {等级: Decimal}}
+        """
+        d = self.days_of_year
+        return {
+            "pca": (self.pca_amount * self.pca_epy_rate) / d,
+            "add_basic": self.add_basic_mag * self.add_rate / d,
+            "add_extra": {
+                level: (mag - self.add_basic_mag) * self.add_rate / d
+                for level, mag in self.add_mag.items()
+            },
+            "add_full": {
+                level: mag * self.add_rate / d for level, mag in self.add_mag.items()
+            },
+            "wmp_emy_basic": self.wmp_emy_basic_cost / d,
+            "wmp_emy_extra": {
+                level: (cost - self.wmp_emy_basic_cost) / d
+                for level, cost in self.wmp_emy_cost.items()
+            },
+            "wmp_sps": {level: cost / d for level, cost in self.wmp_sps_cost.items()},
+            "wmp_chd_basic": self.wmp_chd_basic_cost / d,
+            "wmp_chd_extra": {
+                level: (cost - self.wmp_chd_basic_cost) / d
+                for level, cost in self.wmp_chd_cost.items()
+            },
+            "tl_basic": (self.tl_basic_mag * self.tl_rate) / d,
+            "tl_extra": {
+                level: (mag - self.tl_basic_mag) * self.tl_rate / d
+                for level, mag in self.tl_mag.items()
+            },
+            "tl_full": {
+                level: mag * self.tl_rate / d for level, mag in self.tl_mag.items()
+            },
+            "hi": self.hi_basic_amount * self.hi_rate / d,
+            "akdd_basic": self.akdd_basic_amount * self.akdd_rate / d,
+            "akdd_extra": {
+                level: (amount - self.akdd_basic_amount) * self.akdd_rate / d
+                for level, amount in self.akdd_amount.items()
+            },
+        }
 
     @staticmethod
     def handle_result(res: Decimal):
         if res == Decimal(0):
             return "0"
 
-        getcontext().rounding = "ROUND_HALF_UP"
-        return res.quantize(Decimal("0.00"))
+        # 只在取整时使用 ROUND_HALF_UP, 不修改全局 context,
+        # 否则中间结果的舍入方式取决于进程中此前是否计算过
+        return res.quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+
+    def share(self, result, render: Callable[[], str]) -> Share:
+        """
+        :param result: 金额
+        :param render: 生成计算公式, 不生成公式时不会调用
+        """
+        if not self.with_formula:
+            return Share(result, None)
+
+        return Share(result, render=render)
 
-    def cal_pca(self, cost: Decimal, re_cal: bool = False):
+    def cal_pca(
+        self, cost: Decimal, active_days: int = 0, re_cal: bool = False
+    ) -> CostResult:
         """
         全部员工缴纳
         :param cost: 保费
+        :param active_days: 实际缴纳天数, 只在重新计算保费时使用
         :param re_cal: 重新计算保费 (不使用表格中的保费)
         :return:
         """
         # TODO: finish re_call
         if re_cal:
-            return {
-                "for_company": {
-                    "result": 0,
-                    "formula": "0",
-                },
-                "for_employee": {
-                    "result": self.handle_result(
-                        (self.pca_amount * self.pca_epy_rate)
-                        / self.days_of_year
-                        * self.active_days
-                    ),
-                    "formula": f"({self.pca_amount} * {self.pca_epy_rate}) / {self.days_of_year} * {self.active_days}",
-                },
-            }
+            return CostResult(
+                for_employee=self.share(
+                    self.handle_result(self.day_rates["pca"] * active_days),
+                    lambda: self.pca_formula(False, cost, active_days, re_cal),
+                ),
+            )
 
-        return {
-            "for_company": {
-                "result": 0,
-                "formula": "0",
-            },
-            "for_employee": {
-                "result": cost,
-                "formula": f"{cost}",
-            },
-        }
+        return CostResult(
+            for_employee=self.share(
+                cost, lambda: self.pca_formula(False, cost, active_days, re_cal)
+            ),
+        )
 
-    def cal_add(self, type_: str, level: int, salary_list: List[tuple]):
+    def pca_formula(
+        self,
+        for_company: bool,
+        cost: Decimal,
+        active_days: int = 0,
+        re_cal: bool = False,
+    ) -> Optional[str]:
+        """
+        `cal_pca` 的计算公式, 参数同 `cal_pca`
+        :param for_company: 公司 (True) 或员工 (False) 一方
+        :return: 公式, 该方不缴纳时为 None
+        """
+        if for_company:
+            return None
+
+        if re_cal:
+            return f"({self.pca_amount} * {self.pca_epy_rate}) / {self.days_of_year} * {active_days}"
+
+        return f"{cost}"
+
+    @staticmethod
+    def salary_formula(salary_list: List[tuple]) -> str:
+        return " + ".join([f"{s} * {d}" for s, d in salary_list])
+
+    def cal_add(self, type_: str, level: int, salary_list: List[tuple]) -> CostResult:
         """
         公司缴纳员工的基础倍率
         员工超出倍率员工缴纳
@@ -74,139 +279,146 @@ class CostCalculator:
         mag = self.add_mag.get(level)
         if mag is None:
             # raise KeyError(f"add_mag type: {type_}, level: {level} got None")
-            return {
-                "for_company": {
-                    "result": 0,
-                    "formula": "0",
-                },
-                "for_employee": {
-                    "result": 0,
-                    "formula": "0",
-                },
-            }
+            return CostResult()
 
         salary_tmp = 0
         for salary, day in salary_list:
             salary_tmp += salary * day
 
         if type_ == self.Type.EMPLOYEE:
-            return {
-                "for_company": {
-                    "result": self.handle_result(
-                        self.add_basic_mag
-                        * self.add_rate
-                        / self.days_of_year
-                        * salary_tmp
-                    ),
-                    "formula": f"({self.add_basic_mag} * {self.add_rate}) / {self.days_of_year} * ({' + '.join([f'{s} * {d}' for s, d in salary_list])})",
-                },
-                "for_employee": {
-                    "result": self.handle_result(
-                        (mag - self.add_basic_mag)
-                        * self.add_rate
-                        / self.days_of_year
-                        * salary_tmp
-                    ),
-                    "formula": f"(({mag} - {self.add_basic_mag}) * {self.add_rate}) / {self.days_of_year} * ({' + '.join([f'{s} * {d}' for s, d in salary_list])})",
-                },
-            }
+            return CostResult(
+                for_company=self.share(
+                    self.handle_result(self.day_rates["add_basic"] * salary_tmp),
+                    lambda: self.add_formula(True, type_, level, salary_list),
+                ),
+                for_employee=self.share(
+                    self.handle_result(self.day_rates["add_extra"][level] * salary_tmp),
+                    lambda: self.add_formula(False, type_, level, salary_list),
+                ),
+            )
 
         else:
-            return {
-                "for_company": {
-                    "result": 0,
-                    "formula": "0",
-                },
-                "for_employee": {
-                    "result": self.handle_result(
-                        mag * self.add_rate / self.days_of_year * salary_tmp
-                    ),
-                    "formula": f"({mag} * {self.add_rate}) / {self.days_of_year} * ({' + '.join([f'{s} * {d}' for s, d in salary_list])})",
-                },
-            }
+            return CostResult(
+                for_employee=self.share(
+                    self.handle_result(self.day_rates["add_full"][level] * salary_tmp),
+                    lambda: self.add_formula(False, type_, level, salary_list),
+                ),
+            )
+
+    def add_formula(
+        self, for_company: bool, type_: str, level: int, salary_list: List[tuple]
+    ) -> Optional[str]:
+        """
+        `cal_add` 的计算公式, 参数同 `cal_add`, 返回值同 `pca_formula`
+        """
+        mag = self.add_mag.get(level)
+        if mag is None:
+            return None
+
+        salary = self.salary_formula(salary_list)
+        if type_ == self.Type.EMPLOYEE:
+            if for_company:
+                return f"({self.add_basic_mag} * {self.add_rate}) / {self.days_of_year} * ({salary})"
+
+            return f"(({mag} - {self.add_basic_mag}) * {self.add_rate}) / {self.days_of_year} * ({salary})"
+
+        if for_company:
+            return None
+
+        return f"({mag} * {self.add_rate}) / {self.days_of_year} * ({salary})"
 
-    def cal_wmp(self, type_: str, level: int):
+    def cal_wmp(self, type_: str, level: int, active_days: int) -> CostResult:
         """
         员工及子女基础医疗公司缴纳
         员工及子女超出基础部分员工缴纳
         配偶全部员工缴纳
+        :param active_days: 实际缴纳天数
         :return:
         """
 
         if type_ == self.Type.EMPLOYEE:
             cost = self.wmp_emy_cost.get(level)
             if cost is not None:
-                return {
-                    "for_company": {
-                        "result": self.handle_result(
-                            self.wmp_emy_basic_cost
-                            / self.days_of_year
-                            * self.active_days
+                return CostResult(
+                    for_company=self.share(
+                        self.handle_result(
+                            self.day_rates["wmp_emy_basic"] * active_days
                         ),
-                        "formula": f"{self.wmp_emy_basic_cost} / {self.days_of_year} * {self.active_days}",
-                    },
-                    "for_employee": {
-                        "result": self.handle_result(
-                            (cost - self.wmp_emy_basic_cost)
-                            / self.days_of_year
-                            * self.active_days
+                        lambda: self.wmp_formula(True, type_, level, active_days),
+                    ),
+                    for_employee=self.share(
+                        self.handle_result(
+                            self.day_rates["wmp_emy_extra"][level] * active_days
                         ),
-                        "formula": f"({cost} - {self.wmp_emy_basic_cost}) / {self.days_of_year} * {self.active_days}",
-                    },
-                }
+                        lambda: self.wmp_formula(False, type_, level, active_days),
+                    ),
+                )
 
         elif type_ == self.Type.SPOUSE:
             cost = self.wmp_sps_cost.get(level)
             if cost is not None:
-                return {
-                    "for_company": {
-                        "result": 0,
-                        "formula": "0",
-                    },
-                    "for_employee": {
-                        "result": self.handle_result(
-                            cost / self.days_of_year * self.active_days
+                return CostResult(
+                    for_employee=self.share(
+                        self.handle_result(
+                            self.day_rates["wmp_sps"][level] * active_days
                         ),
-                        "formula": f"{cost} / {self.days_of_year} * {self.active_days}",
-                    },
-                }
+                        lambda: self.wmp_formula(False, type_, level, active_days),
+                    ),
+                )
 
         elif type_ == self.Type.CHILD:
             cost = self.wmp_chd_cost.get(level)
             if cost is not None:
-                return {
-                    "for_company": {
-                        "result": self.handle_result(
-                            self.wmp_chd_basic_cost
-                            / self.days_of_year
-                            * self.active_days
+                return CostResult(
+                    for_company=self.share(
+                        self.handle_result(
+                            self.day_rates["wmp_chd_basic"] * active_days
                         ),
-                        "formula": f"{self.wmp_chd_basic_cost} / {self.days_of_year} * {self.active_days}",
-                    },
-                    "for_employee": {
-                        "result": self.handle_result(
-                            (cost - self.wmp_chd_basic_cost)
-                            / self.days_of_year
-                            * self.active_days
+                        lambda: self.wmp_formula(True, type_, level, active_days),
+                    ),
+                    for_employee=self.share(
+                        self.handle_result(
+                            self.day_rates["wmp_chd_extra"][level] * active_days
                         ),
-                        "formula": f"({cost} - {self.wmp_chd_basic_cost}) / {self.days_of_year} * {self.active_days}",
-                    },
-                }
+                        lambda: self.wmp_formula(False, type_, level, active_days),
+                    ),
+                )
 
         # raise KeyError(f"type{type_}, level{level} got None")
 
-        return {
-            "for_company": {
-                "result": 0,
-                "formula": "0",
-            },
-            "for_employee": {
-                "result": 0,
-                "formula": "0",
-            },
-        }
+        return CostResult()
+
+    def wmp_formula(
+        self, for_company: bool, type_: str, level: int, active_days: int
+    ) -> Optional[str]:
+        """
+        `cal_wmp` 的计算公式, 参数同 `cal_wmp`, 返回值同 `pca_formula`
+        """
+        d = self.days_of_year
+        if type_ == self.Type.EMPLOYEE:
+            cost = self.wmp_emy_cost.get(level)
+            if cost is not None:
+                if for_company:
+                    return f"{self.wmp_emy_basic_cost} / {d} * {active_days}"
+
+                return f"({cost} - {self.wmp_emy_basic_cost}) / {d} * {active_days}"
+
+        elif type_ == self.Type.SPOUSE:
+            cost = self.wmp_sps_cost.get(level)
+            if cost is not None and not for_company:
+                return f"{cost} / {d} * {active_days}"
 
-    def cal_tl(self, type_: str, level: int, salary_list: list):
+        elif type_ == self.Type.CHILD:
+            cost = self.wmp_chd_cost.get(level)
+            if cost is not None:
+                if for_company:
+                    return f"{self.wmp_chd_basic_cost} / {d} * {active_days}"
+
+                return f"({cost} - {self.wmp_chd_basic_cost}) / {d} * {active_days}"
+
+        return None
+
+    def cal_tl(self, type_: str, level: int, salary_list: list) -> CostResult:
         """
         公司缴纳员工的基础倍率
         员工超出倍率员工缴纳
@@ -216,127 +428,557 @@ class CostCalculator:
         mag = self.tl_mag.get(level)
         if mag is None:
             # raise KeyError(f"tl_mag type{type_}, level{level} got None")
-            return {
-                "for_company": {
-                    "result": 0,
-                    "formula": "0",
-                },
-                "for_employee": {
-                    "result": 0,
-                    "formula": "0",
-                },
-            }
+            return CostResult()
 
         salary_tmp = 0
         for salary, day in salary_list:
             salary_tmp += salary * day
 
         if type_ == self.Type.EMPLOYEE:
-            return {
-                "for_company": {
-                    "result": self.handle_result(
-                        (self.tl_basic_mag * self.tl_rate)
-                        / self.days_of_year
-                        * salary_tmp
-                    ),
-                    "formula": f"({self.tl_basic_mag} * {self.tl_rate}) / {self.days_of_year} * ({' + '.join([f'{s} * {d}' for s, d in salary_list])})",
-                },
-                "for_employee": {
-                    "result": self.handle_result(
-                        (mag - self.tl_basic_mag)
-                        * self.tl_rate
-                        / self.days_of_year
-                        * salary_tmp
-                    ),
-                    "formula": f"(({mag} - {self.tl_basic_mag}) * {self.tl_rate}) / {self.days_of_year} * ({' + '.join([f'{s} * {d}' for s, d in salary_list])})",
-                },
-            }
+            return CostResult(
+                for_company=self.share(
+                    self.handle_result(self.day_rates["tl_basic"] * salary_tmp),
+                    lambda: self.tl_formula(True, type_, level, salary_list),
+                ),
+                for_employee=self.share(
+                    self.handle_result(self.day_rates["tl_extra"][level] * salary_tmp),
+                    lambda: self.tl_formula(False, type_, level, salary_list),
+                ),
+            )
 
         else:
-            return {
-                "for_company": {
-                    "result": 0,
-                    "formula": "0",
-                },
-                "for_employee": {
-                    "result": self.handle_result(
-                        mag * self.tl_rate / self.days_of_year * salary_tmp
-                    ),
-                    "formula": f"({mag} * {self.tl_rate}) / {self.days_of_year} * ({' + '.join([f'{s} * {d}' for s, d in salary_list])})",
-                },
-            }
+            return CostResult(
+                for_employee=self.share(
+                    self.handle_result(self.day_rates["tl_full"][level] * salary_tmp),
+                    lambda: self.tl_formula(False, type_, level, salary_list),
+                ),
+            )
+
+    def tl_formula(
+        self, for_company: bool, type_: str, level: int, salary_list: list
+    ) -> Optional[str]:
+        """
+        `cal_tl` 的计算公式, 参数同 `cal_tl`, 返回值同 `pca_formula`
+        """
+        mag = self.tl_mag.get(level)
+        if mag is None:
+            return None
+
+        salary = self.salary_formula(salary_list)
+        if type_ == self.Type.EMPLOYEE:
+            if for_company:
+                return f"({self.tl_basic_mag} * {self.tl_rate}) / {self.days_of_year} * ({salary})"
+
+            return f"(({mag} - {self.tl_basic_mag}) * {self.tl_rate}) / {self.days_of_year} * ({salary})"
 
-    def cal_hi(self, cost: Decimal, re_cal: bool = False):
+        if for_company:
+            return None
+
+        return f"({mag} * {self.tl_rate}) / {self.days_of_year} * ({salary})"
+
+    def cal_hi(
+        self, cost: Decimal, active_days: int = 0, re_cal: bool = False
+    ) -> CostResult:
         """
         全部公司缴纳
         :param cost: 保费
+        :param active_days: 实际缴纳天数, 只在重新计算保费时使用
         :param re_cal: 重新计算保费 (不使用表格中的保费)
         :return:
         """
         if re_cal:
-            return {
-                "for_company": {
-                    "result": self.handle_result(
-                        self.hi_basic_amount
-                        * self.hi_rate
-                        / self.days_of_year
-                        * self.active_days
-                    ),
-                    "formula": f"({self.hi_basic_amount} * {self.hi_rate}) / {self.days_of_year} * {self.active_days}",
-                },
-                "for_employee": {
-                    "result": 0,
-                    "formula": "0",
-                },
-            }
+            return CostResult(
+                for_company=self.share(
+                    self.handle_result(self.day_rates["hi"] * active_days),
+                    lambda: self.hi_formula(True, cost, active_days, re_cal),
+                ),
+            )
 
-        return {
-            "for_company": {
-                "result": cost,
-                "formula": f"{cost}",
-            },
-            "for_employee": {
-                "result": 0,
-                "formula": "0",
-            },
-        }
+        return CostResult(
+            for_company=self.share(
+                cost, lambda: self.hi_formula(True, cost, active_days, re_cal)
+            ),
+        )
+
+    def hi_formula(
+        self,
+        for_company: bool,
+        cost: Decimal,
+        active_days: int = 0,
+        re_cal: bool = False,
+    ) -> Optional[str]:
+        """
+        `cal_hi` 的计算公式, 参数同 `cal_hi`, 返回值同 `pca_formula`
+        """
+        if not for_company:
+            return None
 
-    def cal_akdd(self, level: int):
+        if re_cal:
+            return f"({self.hi_basic_amount} * {self.hi_rate}) / {self.days_of_year} * {active_days}"
+
+        return f"{cost}"
+
+    def cal_akdd(self, level: int, active_days: int) -> CostResult:
         """
         基础保额公司缴纳
         超出基础部分保额员工缴纳
         :param level:
+        :param active_days: 实际缴纳天数
         :return:
         """
         amount = self.akdd_amount.get(level)
         if amount is None:
             # raise KeyError(f"akdd_amount level{level} got None")
-            return {
-                "for_company": {
-                    "result": 0,
-                    "formula": "0",
-                },
-                "for_employee": {
-                    "result": 0,
-                    "formula": "0",
-                },
-            }
+            return CostResult()
 
-        return {
-            "for_company": {
-                "result": self.handle_result(
-                    self.akdd_basic_amount
-                    * self.akdd_rate
-                    / self.days_of_year
-                    * self.active_days
-                ),
-                "formula": f"({self.akdd_basic_amount} * {self.akdd_rate}) / {self.days_of_year} * {self.active_days}",
+        return CostResult(
+            for_company=self.share(
+                self.handle_result(self.day_rates["akdd_basic"] * active_days),
+                lambda: self.akdd_formula(True, level, active_days),
+            ),
+            for_employee=self.share(
+                self.handle_result(self.day_rates["akdd_extra"][level] * active_days),
+                lambda: self.akdd_formula(False, level, active_days),
+            ),
+        )
+
+    def akdd_formula(
+        self, for_company: bool, level: int, active_days: int
+    ) -> Optional[str]:
+        """
+        `cal_akdd` 的计算公式, 参数同 `cal_akdd`, 返回值同 `pca_formula`
+        """
+        amount = self.akdd_amount.get(level)
+        if amount is None:
+            return None
+
+        if for_company:
+            return f"({self.akdd_basic_amount} * {self.akdd_rate}) / {self.days_of_year} * {active_days}"
+
+        return f"({amount} - {self.akdd_basic_amount}) * {self.akdd_rate} / {self.days_of_year} * {active_days}"
+
+
+class FixedPoint:
+    """
+    整数定点运算, 数值表示为 (系数, 指数), 即 系数 * 10 ** 指数
+    乘法与加法的结果按 `prec` 位有效数字 ROUND_HALF_EVEN 取整, 与 Decimal 默认 context 相同,
+    因此与 Decimal 逐项计算的结果完全一致
+    不读取也不修改 Decimal 的 context, 可以在多线程中使用
+    prec: 有效数字位数
+    """
+
+    def __init__(self, prec: int = 28):
+        self.prec = prec
+        self.limit = 10**prec
+        # 将 Decimal 转换为整数系数时使用, 不受全局 context 影响
+        self.exact = Context(prec=MAX_PREC)
+
+    def convert(self, num) -> Tuple[int, int]:
+        """
+        将 int / float / Decimal / str 精确转换为 (系数, 指数), 与 `Decimal(num)` 的值相同
+        """
+        if isinstance(num, int):
+            return num, 0
+
+        if isinstance(num, float):
+            if not math.isfinite(num):
+                raise ValueError(f"Not a finite number: {num}")
+
+            # 分母为 2 ** k, 乘以 5 ** k 后为 10 ** k
+            n, d = num.as_integer_ratio()
+            k = d.bit_length() - 1
+            return n * 5**k, -k
+
+        if not isinstance(num, Decimal):
+            num = Decimal(num)
+        if not num.is_finite():
+            raise ValueError(f"Not a finite number: {num}")
+
+        exp = num.as_tuple().exponent
+        return int(num.scaleb(-exp, self.exact)), exp
+
+    def round(self, n: int, exp: int) -> Tuple[int, int]:
+        """
+        取 `prec` 位有效数字, ROUND_HALF_EVEN
+        """
+        a = abs(n)
+        if a < self.limit:
+            return n, exp
+
+        drop = len(str(a)) - self.prec
+        q, r = divmod(a, 10**drop)
+        half = 5 * 10 ** (drop - 1)
+        if r > half or (r == half and q & 1):
+            q += 1
+
+        return (q if n > 0 else -q), exp + drop
+
+    def mul(self, a: Tuple[int, int], b: Tuple[int, int]) -> Tuple[int, int]:
+        return self.round(a[0] * b[0], a[1] + b[1])
+
+    def add(self, a: Tuple[int, int], b: Tuple[int, int]) -> Tuple[int, int]:
+        exp = min(a[1], b[1])
+        n = a[0] * 10 ** (a[1] - exp) + b[0] * 10 ** (b[1] - exp)
+        return self.round(n, exp)
+
+    @staticmethod
+    def to_fen(num: Tuple[int, int]) -> int:
+        """
+        ROUND_HALF_UP 取整到分, 与 `CostCalculator.handle_result` 一致
+        """
+        n, exp = num
+        if exp >= -2:
+            return n * 10 ** (exp + 2)
+
+        unit = 10 ** (-2 - exp)
+        q, r = divmod(abs(n), unit)
+        if 2 * r >= unit:
+            q += 1
+
+        return q if n > 0 else -q
+
+
+class BatchCostCalculator(CostCalculator):
+    """
+    批量计算器
+    按列计算整张表, 费率表与 `CostCalculator` 相同
+    使用 `FixedPoint` 整数运算, 每行不创建 Decimal,
+    结果与 `CostCalculator` 逐行计算并经 `handle_result` 取整后的结果一致
+    `cal_*_batch` 以分 (int) 为单位返回, `cal_*_results` 返回与逐行计算相同形式的金额
+    rates: 费率表, 见 `CostCalculator`
+    days_of_year: 费率对应天数
+    with_formula: 见 `CostCalculator`, 批量计算只计算金额, 公式由 `*_formula` 逐行生成
+    """
+
+    def __init__(
+        self, rates: dict = None, days_of_year: int = 365, with_formula: bool = True
+    ):
+        super().__init__(rates, days_of_year=days_of_year, with_formula=with_formula)
+        self.fixed = FixedPoint(getcontext().prec)
+        self.fixed_rates = {
+            name: (
+                {level: self.fixed.convert(v) for level, v in value.items()}
+                if isinstance(value, dict)
+                else self.fixed.convert(value)
+            )
+            for name, value in self.day_rates.items()
+        }
+
+    @classmethod
+    def from_calculator(cls, calculator: CostCalculator) -> "BatchCostCalculator":
+        """
+        使用与 `calculator` 相同的费率表、天数与公式设置
+        """
+        if isinstance(calculator, cls):
+            return calculator
+
+        return cls(
+            calculator.rates(),
+            days_of_year=calculator.days_of_year,
+            with_formula=calculator.with_formula,
+        )
+
+    @staticmethod
+    def to_fen(num) -> int:
+        """
+        将以元为单位的金额 ROUND_HALF_UP 取整到分
+        """
+        res = Decimal(num).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+        return int(res.scaleb(2))
+
+    @staticmethod
+    def to_yuan(fen: int) -> Decimal:
+        """
+        将分转换为以元为单位的 Decimal
+        """
+        return Decimal(fen).scaleb(-2)
+
+    def to_result(self, value: Optional[Tuple[int, int]]):
+        """
+        将 `FixedPoint` 数值转换为与逐行计算相同的结果
+        :param value: 为 None 时该方不缴纳
+        :return: 不缴纳时为 0 (同 `Share` 默认值), 恰好为 0 时为 "0", 否则同 `handle_result`
+        """
+        if value is None:
+            return 0
+
+        if value[0] == 0:
+            return "0"
+
+        res = self.to_yuan(self.fixed.to_fen(value))
+        # 取整为 0 的负数, `quantize` 保留符号
+        return res.copy_negate() if value[0] < 0 and not res else res
+
+    def _values(self, coefs: list, bases: list, convert: Callable) -> Tuple[list, list]:
+        """
+        结果 = 每天的费率 * 基数
+        相同的 (费率, 基数) 只计算一次, 以天数为基数时大部分行可以直接使用已有结果
+        :param coefs: 每行 (公司费率, 员工费率), 费率为 `fixed_rates` 中的值, None 表示该方不缴纳
+        :param bases: 每行计算基数, `FixedPoint` 数值
+        :param convert: 转换每个结果 (`FixedPoint` 数值, 不缴纳为 None)
+        :return: (公司缴纳, 员工缴纳)
+        """
+        mul = self.fixed.mul
+        cache = {}
+        company = []
+        employee = []
+        for key in zip(coefs, bases):
+            res = cache.get(key)
+            if res is None:
+                (com, emy), base = key
+                res = cache[key] = (
+                    convert(None if com is None else mul(com, base)),
+                    convert(None if emy is None else mul(emy, base)),
+                )
+
+            company.append(res[0])
+            employee.append(res[1])
+
+        return company, employee
+
+    def _fen(self, value: Optional[Tuple[int, int]]) -> int:
+        return 0 if value is None else self.fixed.to_fen(value)
+
+    def _batch(self, coefs: list, bases: list) -> Tuple[List[int], List[int]]:
+        """
+        见 `_values`, 单位为分, 不缴纳为 0
+        """
+        return self._values(coefs, bases, self._fen)
+
+    def _results(self, coefs: list, bases: list) -> Tuple[list, list]:
+        """
+        见 `_values`, 结果见 `to_result`
+        """
+        return self._values(coefs, bases, self.to_result)
+
+    @staticmethod
+    def _days_args(coef: tuple, active_days: Sequence[int]):
+        """
+        所有行费率相同, 以实际缴纳天数为基数
+        """
+        return [coef] * len(active_days), [(int(days), 0) for days in active_days]
+
+    def _mag_args(
+        self,
+        prefix: str,
+        types: Sequence[str],
+        levels: Sequence[int],
+        salaries: Sequence[Decimal],
+        active_days: Sequence[int],
+        salary_lists: Sequence[Optional[list]] = None,
+    ):
+        """
+        `cal_add` / `cal_tl` 的批量实现, 以 工资 * 实际缴纳天数 为基数,
+        有 `salary_list` 的行以各段 工资 * 天数 之和为基数
+        """
+        rates = self.fixed_rates
+        basic = rates[f"{prefix}_basic"]
+        epy_coefs = {
+            level: (basic, extra) for level, extra in rates[f"{prefix}_extra"].items()
+        }
+        other_coefs = {
+            level: (None, full) for level, full in rates[f"{prefix}_full"].items()
+        }
+
+        if salary_lists is None:
+            salary_lists = [None] * len(types)
+
+        fixed = self.fixed
+        coefs = []
+        bases = []
+        for type_, level, salary, days, salary_list in zip(
+            types, levels, salaries, active_days, salary_lists
+        ):
+            table = epy_coefs if type_ == self.Type.EMPLOYEE else other_coefs
+            coefs.append(table.get(level, (None, None)))
+            if salary_list is None:
+                bases.append(fixed.mul(fixed.convert(salary), (int(days), 0)))
+            else:
+                bases.append(self.salary_base(salary_list))
+
+        return coefs, bases
+
+    def salary_base(self, salary_list: List[tuple]) -> Tuple[int, int]:
+        """
+        各段 工资 * 天数 之和, 与 `cal_add` 中 `salary_tmp` 的计算顺序相同
+        """
+        fixed = self.fixed
+        res = (0, 0)
+        for salary, day in salary_list:
+            res = fixed.add(res, fixed.mul(fixed.convert(salary), fixed.convert(day)))
+
+        return res
+
+    def _wmp_args(
+        self, types: Sequence[str], levels: Sequence[int], active_days: Sequence[int]
+    ):
+        rates = self.fixed_rates
+        tables = {
+            self.Type.EMPLOYEE: {
+                level: (rates["wmp_emy_basic"], extra)
+                for level, extra in rates["wmp_emy_extra"].items()
             },
-            "for_employee": {
-                "result": self.handle_result(amount - self.akdd_basic_amount)
-                * self.akdd_rate
-                / self.days_of_year
-                * self.active_days,
-                "formula": f"({amount} - {self.akdd_basic_amount}) * {self.akdd_rate} / {self.days_of_year} * {self.active_days}",
+            self.Type.SPOUSE: {
+                level: (None, full) for level, full in rates["wmp_sps"].items()
             },
+            self.Type.CHILD: {
+                level: (rates["wmp_chd_basic"], extra)
+                for level, extra in rates["wmp_chd_extra"].items()
+            },
+        }
+
+        coefs = [
+            tables.get(type_, {}).get(level, (None, None))
+            for type_, level in zip(types, levels)
+        ]
+        return coefs, [(int(days), 0) for days in active_days]
+
+    def _akdd_args(self, levels: Sequence[int], active_days: Sequence[int]):
+        rates = self.fixed_rates
+        table = {
+            level: (rates["akdd_basic"], extra)
+            for level, extra in rates["akdd_extra"].items()
+        }
+
+        coefs = [table.get(level, (None, None)) for level in levels]
+        return coefs, [(int(days), 0) for days in active_days]
+
+    def cal_pca_batch(
+        self, costs: Sequence[Decimal], active_days: Sequence[int], re_cal: bool = False
+    ):
+        """
+        `cal_pca` 的批量版本
+        :param costs: 每行保费
+        :param active_days: 每行实际缴纳天数
+        :param re_cal: 重新计算保费 (不使用表格中的保费)
+        :return: (公司缴纳, 员工缴纳), 单位为分
+        """
+        costs = list(costs)
+        if not re_cal:
+            return [0] * len(costs), [self.to_fen(cost) for cost in costs]
+
+        return self._batch(
+            *self._days_args((None, self.fixed_rates["pca"]), list(active_days))
+        )
+
+    def cal_add_batch(
+        self,
+        types: Sequence[str],
+        levels: Sequence[int],
+        salaries: Sequence[Decimal],
+        active_days: Sequence[int],
+        salary_lists: Sequence[Optional[list]] = None,
+    ):
+        """
+        `cal_add` 的批量版本
+        :param types: 每行类型
+        :param levels: 每行等级
+        :param salaries: 每行工资
+        :param active_days: 每行实际缴纳天数
+        :param salary_lists: 每行按工资变动拆分的 `salary_list`, 为 None 的行使用 `salaries`
+        :return: (公司缴纳, 员工缴纳), 单位为分
+        """
+        return self._batch(
+            *self._mag_args("add", types, levels, salaries, active_days, salary_lists)
+        )
+
+    def cal_wmp_batch(
+        self, types: Sequence[str], levels: Sequence[int], active_days: Sequence[int]
+    ):
+        """
+        `cal_wmp` 的批量版本
+        :param types: 每行类型
+        :param levels: 每行等级
+        :param active_days: 每行实际缴纳天数
+        :return: (公司缴纳, 员工缴纳), 单位为分
+        """
+        return self._batch(*self._wmp_args(types, levels, active_days))
+
+    def cal_tl_batch(
+        self,
+        types: Sequence[str],
+        levels: Sequence[int],
+        salaries: Sequence[Decimal],
+        active_days: Sequence[int],
+        salary_lists: Sequence[Optional[list]] = None,
+    ):
+        """
+        `cal_tl` 的批量版本, 参数同 `cal_add_batch`
+        :return: (公司缴纳, 员工缴纳), 单位为分
+        """
+        return self._batch(
+            *self._mag_args("tl", types, levels, salaries, active_days, salary_lists)
+        )
+
+    def cal_hi_batch(
+        self, costs: Sequence[Decimal], active_days: Sequence[int], re_cal: bool = False
+    ):
+        """
+        `cal_hi` 的批量版本
+        :param costs: 每行保费
+        :param active_days: 每行实际缴纳天数
+        :param re_cal: 重新计算保费 (不使用表格中的保费)
+        :return: (公司缴纳, 员工缴纳), 单位为分
+        """
+        costs = list(costs)
+        if not re_cal:
+            return [self.to_fen(cost) for cost in costs], [0] * len(costs)
+
+        return self._batch(
+            *self._days_args((self.fixed_rates["hi"], None), list(active_days))
+        )
+
+    def cal_akdd_batch(self, levels: Sequence[int], active_days: Sequence[int]):
+        """
+        `cal_akdd` 的批量版本
+        :param levels: 每行等级
+        :param active_days: 每行实际缴纳天数
+        :return: (公司缴纳, 员工缴纳), 单位为分
+        """
+        return self._batch(*self._akdd_args(levels, active_days))
+
+    def cal_plan_results(
+        self,
+        plans: Sequence[dict],
+        salaries: Sequence[Decimal],
+        active_days: Sequence[int],
+        salary_lists: Sequence[Optional[list]] = None,
+    ) -> dict:
+        """
+        按计划计算 ADD / WMP / TL / AKDD, 与逐行调用 `cal_*` 的结果一致
+        :param plans: 每行的计划, 见 `AutoMapHandler.compile_plan`
+        :param salaries: 每行工资, 必须为有限的数
+        :param active_days: 每行实际缴纳天数
+        :param salary_lists: 每行按工资变动拆分的 `salary_list`, 见 `cal_add_batch`
+        :return: {产品前缀: (公司缴纳, 员工缴纳)}, 金额同 `to_result`
+        """
+        add = [plan["add"] for plan in plans]
+        wmp = [plan["wmp"] for plan in plans]
+        tl = [plan["tl"] for plan in plans]
+        akdd_levels = [plan["akdd"][1] for plan in plans]
+        return {
+            "ADD": self._results(
+                *self._mag_args(
+                    "add",
+                    [p[0] for p in add],
+                    [p[1] for p in add],
+                    salaries,
+                    active_days,
+                    salary_lists,
+                )
+            ),
+            "WMP": self._results(
+                *self._wmp_args([p[0] for p in wmp], [p[1] for p in wmp], active_days)
+            ),
+            "TL": self._results(
+                *self._mag_args(
+                    "tl",
+                    [p[0] for p in tl],
+                    [p[1] for p in tl],
+                    salaries,
+                    active_days,
+                    salary_lists,
+                )
+            ),
+            "AKDD": self._results(*self._akdd_args(akdd_levels, active_days)),
         }
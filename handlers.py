@@ -1,10 +1,44 @@
+"""
+pandas 与 openpyxl 只在实际读写表格时导入, 导入本模块本身很快 (见 `quote.py`)
+"""
+
+from __future__ import annotations
+
+import bisect
+import copy
+import cProfile
+import hashlib
+import json
+import math
+import os
+import pickle
+import pstats
 import re
+import sqlite3
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from decimal import Decimal, InvalidOperation
-from typing import List, Tuple
-
-import pandas as pd
-from calculator import CostCalculator
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from functools import lru_cache
+from itertools import islice
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from calculator import BatchCostCalculator, CostCalculator
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def time_serialize(time_str: str):
@@ -15,6 +49,799 @@ def time_serialize(time_str: str):
     return datetime(year=year, month=month, day=day)
 
 
+def is_null(value) -> bool:
+    """
+    单个单元格是否为空 (None / NaN), 与 `pd.isnull` 一致, 不需要导入 pandas
+    空的保费单元格经 `ExcelHandler.to_decimal` 后为 Decimal("NaN"), 同样视为空
+    """
+    if isinstance(value, float):
+        return math.isnan(value)
+    if isinstance(value, Decimal):
+        return value.is_nan()
+
+    return value is None
+
+
+def is_date(value) -> bool:
+    """
+    单个单元格是否为日期, 与 `ExcelHandler.validate` 一致 (格式为 %Y/%m/%d, 或单元格本身为日期)
+    """
+    if isinstance(value, datetime):
+        return True
+    if not isinstance(value, str):
+        return False
+
+    try:
+        datetime.strptime(value, "%Y/%m/%d")
+    except ValueError:
+        return False
+
+    return True
+
+
+def is_number(value) -> bool:
+    """
+    单个单元格是否为数字, 与 `pd.to_numeric` 一致, 空单元格不是数字
+    """
+    if isinstance(value, bool) or is_null(value):
+        return False
+
+    try:
+        return not math.isnan(float(value))
+    except (TypeError, ValueError):
+        return False
+
+
+@lru_cache(maxsize=4096)
+def parse_date(time_str: str) -> datetime:
+    """
+    `time_serialize` 的缓存版本, 表格中不同的日期字符串数量有限
+    单元格本身为日期时直接返回
+    """
+    if isinstance(time_str, datetime):
+        return time_str
+
+    return time_serialize(time_str)
+
+
+# 子进程中用于分块计算的 ExcelHandler, 由 `_init_chunk_worker` 设置
+_chunk_handler = None
+
+
+def cost_plan(
+    calculator: CostCalculator,
+    plan: dict,
+    salary: Decimal,
+    active_days: int,
+    pca_cost: Decimal,
+    hi_cost: Decimal,
+    salary_list: List[tuple] = None,
+) -> dict:
+    """
+    按计划计算一名员工
+    :param calculator: 计算器
+    :param plan: 见 `AutoMapHandler.compile_plan`
+    :param salary: 工资
+    :param active_days: 实际缴纳天数
+    :param pca_cost: 表格中的 PCA 保费
+    :param hi_cost: 表格中的 HI 保费
+    :param salary_list: 按工资变动拆分的 [(工资, 天数), ...], 为 None 时整个期间使用 `salary`
+    :return: {新列名: 值}
+    """
+    auto_name_dict = plan["names"]
+    res = {
+        "PCA_type": auto_name_dict["pca"],
+        "ADD_type": auto_name_dict["add"],
+        "WMP_type": auto_name_dict["wmp"],
+        "TL_type": auto_name_dict["tl"],
+        "HI_type": auto_name_dict["hi"],
+        "AKDD_type": auto_name_dict["akdd"],
+    }
+
+    # 计算
+    c = calculator
+    if salary_list is None:
+        salary_list = [(salary, Decimal(active_days))]
+
+    add_type, add_level = plan["add"]
+    wmp_type, wmp_level = plan["wmp"]
+    tl_type, tl_level = plan["tl"]
+    _, akdd_level = plan["akdd"]
+
+    pca_data = c.cal_pca(pca_cost, active_days)
+    add_data = c.cal_add(add_type, add_level, salary_list)
+    wmp_data = c.cal_wmp(wmp_type, wmp_level, active_days)
+    tl_data = c.cal_tl(tl_type, tl_level, salary_list)
+    hi_data = c.cal_hi(hi_cost, active_days)
+    akdd_data = c.cal_akdd(akdd_level, active_days)
+
+    # 不输出公式时不访问 `formula`, 未缴纳一方的默认公式 "0" 也不输出
+    with_formula = c.with_formula
+    for pre, data in (
+        ("PCA", pca_data),
+        ("ADD", add_data),
+        ("WMP", wmp_data),
+        ("TL", tl_data),
+        ("HI", hi_data),
+        ("AKDD", akdd_data),
+    ):
+        res[f"{pre}_for_com"] = data.for_company.result
+        res[f"{pre}_com_formula"] = data.for_company.formula if with_formula else None
+        res[f"{pre}_for_emy"] = data.for_employee.result
+        res[f"{pre}_emy_formula"] = data.for_employee.formula if with_formula else None
+
+    return res
+
+
+def cost_plans(
+    calculator: BatchCostCalculator,
+    plans: List[dict],
+    salaries: List[Decimal],
+    active_days: List[int],
+    pca_costs: List[Decimal],
+    hi_costs: List[Decimal],
+    salary_lists: List[Optional[List[tuple]]] = None,
+) -> List[dict]:
+    """
+    `cost_plan` 的批量版本, 结果与逐行调用 `cost_plan` 一致
+    ADD / WMP / TL / AKDD 的金额由 `BatchCostCalculator` 按列一次算出,
+    PCA / HI 不重新计算, 直接使用表格中的保费, 只有输出公式时才逐行生成公式
+    有工资变动的行以各段 工资 * 天数 之和为基数一并计算,
+    用到的工资不是有限的数 (如空单元格) 的行仍由 `cost_plan` 逐行计算
+    :param calculator: 批量计算器
+    :param plans: 每行的计划, 其余参数同 `cost_plan`, 均为每行的值
+    :return: 每行 {新列名: 值}
+    """
+    c = calculator
+    n = len(plans)
+    if salary_lists is None:
+        salary_lists = [None] * n
+
+    bulk = [
+        i
+        for i in range(n)
+        if all(s.is_finite() for s, _ in salary_lists[i] or [(salaries[i], None)])
+    ]
+    amounts = c.cal_plan_results(
+        [plans[i] for i in bulk],
+        [salaries[i] for i in bulk],
+        [active_days[i] for i in bulk],
+        [salary_lists[i] for i in bulk],
+    )
+
+    # 以天数为基数的公式只取决于类型、等级与天数, 在各行之间大量重复
+    memo = {}
+
+    def formulas(render: Callable, *args) -> Tuple[str, str]:
+        key = (render,) + args
+        res = memo.get(key)
+        if res is None:
+            res = memo[key] = both_formulas(render, *args)
+        return res
+
+    def both_formulas(render: Callable, *args) -> Tuple[str, str]:
+        # 未缴纳一方的公式同 `Share` 默认值
+        return render(True, *args) or "0", render(False, *args) or "0"
+
+    results = [None] * n
+    with_formula = c.with_formula
+    add_com, add_emy = amounts["ADD"]
+    wmp_com, wmp_emy = amounts["WMP"]
+    tl_com, tl_emy = amounts["TL"]
+    akdd_com, akdd_emy = amounts["AKDD"]
+    keys = [
+        (f"{pre}_for_com", f"{pre}_com_formula", f"{pre}_for_emy", f"{pre}_emy_formula")
+        for pre in ("PCA", "ADD", "WMP", "TL", "HI", "AKDD")
+    ]
+    for j, i in enumerate(bulk):
+        plan = plans[i]
+        days = active_days[i]
+        auto_name_dict = plan["names"]
+        res = {
+            "PCA_type": auto_name_dict["pca"],
+            "ADD_type": auto_name_dict["add"],
+            "WMP_type": auto_name_dict["wmp"],
+            "TL_type": auto_name_dict["tl"],
+            "HI_type": auto_name_dict["hi"],
+            "AKDD_type": auto_name_dict["akdd"],
+        }
+
+        # 与 `cost_plan` 相同, 未缴纳一方为 0
+        shares = (
+            (0, pca_costs[i]),
+            (add_com[j], add_emy[j]),
+            (wmp_com[j], wmp_emy[j]),
+            (tl_com[j], tl_emy[j]),
+            (hi_costs[i], 0),
+            (akdd_com[j], akdd_emy[j]),
+        )
+        if with_formula:
+            add_type, add_level = plan["add"]
+            wmp_type, wmp_level = plan["wmp"]
+            tl_type, tl_level = plan["tl"]
+            _, akdd_level = plan["akdd"]
+            salary_list = salary_lists[i] or [(salaries[i], Decimal(days))]
+            shares_formulas = (
+                both_formulas(c.pca_formula, pca_costs[i], days),
+                both_formulas(c.add_formula, add_type, add_level, salary_list),
+                formulas(c.wmp_formula, wmp_type, wmp_level, days),
+                both_formulas(c.tl_formula, tl_type, tl_level, salary_list),
+                both_formulas(c.hi_formula, hi_costs[i], days),
+                formulas(c.akdd_formula, akdd_level, days),
+            )
+        else:
+            shares_formulas = ((None, None),) * len(shares)
+
+        for (com, emy), (com_formula, emy_formula), names in zip(
+            shares, shares_formulas, keys
+        ):
+            res.update(zip(names, (com, com_formula, emy, emy_formula)))
+
+        results[i] = res
+
+    for i in range(n):
+        if results[i] is None:
+            results[i] = cost_plan(
+                c,
+                plans[i],
+                salaries[i],
+                active_days[i],
+                pca_costs[i],
+                hi_costs[i],
+                salary_lists[i],
+            )
+
+    return results
+
+
+def _init_chunk_worker(handler: "ExcelHandler"):
+    global _chunk_handler
+    _chunk_handler = handler
+
+
+def _handle_chunk(chunk: List[Tuple[tuple, int]]) -> List[dict]:
+    return _chunk_handler.handle_batch(
+        [values for values, _ in chunk], [days for _, days in chunk]
+    )
+
+
+class Instrument:
+    """
+    运行统计: 各阶段耗时, 各产品计算行数
+    profile: 是否使用 cProfile 记录函数耗时
+    trace_memory: 是否使用 tracemalloc 记录内存峰值
+    """
+
+    def __init__(self, profile: bool = False, trace_memory: bool = False):
+        self.stages = {}
+        self.counters = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.peak_memory = None
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def finish(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            _, self.peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        记录 `with` 块的耗时, 同名阶段累加
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def count(self, group: str, name: str, n: int = 1):
+        counter = self.counters.setdefault(group, {})
+        counter[name] = counter.get(name, 0) + n
+
+    def profile_stats(self, limit: int = 30) -> List[dict]:
+        """
+        :return: 累计耗时最多的 `limit` 个函数
+        """
+        stats = pstats.Stats(self.profiler).stats
+        res = []
+        for (filename, line, func), (_, calls, tottime, cumtime, _) in stats.items():
+            res.append(
+                {
+                    "function": f"{filename}:{line}({func})",
+                    "calls": calls,
+                    "tottime": round(tottime, 6),
+                    "cumtime": round(cumtime, 6),
+                }
+            )
+
+        res.sort(key=lambda r: r["cumtime"], reverse=True)
+        return res[:limit]
+
+    def report(self) -> dict:
+        res = {
+            "stages": {name: round(t, 6) for name, t in self.stages.items()},
+            "counters": self.counters,
+        }
+        if self.profiler is not None:
+            res["profile"] = self.profile_stats()
+
+        if self.peak_memory is not None:
+            res["peak_memory"] = self.peak_memory
+
+        return res
+
+
+class WorkbookLoader:
+    """
+    用于读取 excel, 每个文件只解析一次
+    engine: pandas 读取引擎, 为 None 时安装了 python-calamine 则使用 calamine,
+    否则使用 openpyxl (只读模式)
+    """
+
+    def __init__(self, engine: Optional[str] = None):
+        self.engine = engine or self.default_engine()
+
+    @staticmethod
+    def default_engine() -> str:
+        try:
+            import python_calamine  # noqa: F401
+        except ImportError:
+            return "openpyxl"
+
+        return "calamine"
+
+    def read(self, path: str, sheet_name=0, **kwargs) -> pd.DataFrame:
+        import pandas as pd
+
+        return pd.read_excel(path, sheet_name=sheet_name, engine=self.engine, **kwargs)
+
+    def load(
+        self, path: str, header_from: int, header_to: int, sheet_name=0
+    ) -> Tuple[List[str], pd.DataFrame]:
+        """
+        读取带多行表头的 sheet
+        :param path: 文件路径
+        :param header_from: header 起始行 (从 1 开始)
+        :param header_to: header 结束行
+        :return: (合并后的表头, 数据), 数据的 index 从 `header_to` 开始记
+        """
+        raw = self.read(path, sheet_name, header=None)
+        header_rows = raw.iloc[header_from - 1 : header_to].values.tolist()
+        headers = self.header_handler(header_rows)
+
+        df = raw.loc[header_to:]
+        df.columns = headers
+        return headers, df
+
+    @staticmethod
+    def header_handler(header_rows: List[list]) -> List[str]:
+        """
+        用于将多行索引(mutiindex) 转换为单行索引, 每列依次拼接各行 (行数不限) 的非空单元格
+        重复的列名与 pandas 一致, 依次加上 `.1`, `.2` 后缀
+        :param header_rows: header 所在的各行
+        :return:
+        """
+        headers = []
+        seen = {}
+        for c in range(max(len(row) for row in header_rows)):
+            header = []
+            for row in header_rows:
+                cell = row[c] if c < len(row) else None
+                header.append("" if is_null(cell) else str(cell))
+
+            name = "".join(header)
+            if name in seen:
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+
+            headers.append(name)
+
+        return headers
+
+
+class ResultWriter:
+    """
+    输出计算结果
+    fmt: 输出格式 (xlsx / csv / parquet), 为 None 时由输出路径的扩展名决定
+    engine: xlsx 写入引擎, 为 None 时安装了 xlsxwriter 则使用 xlsxwriter
+    (constant_memory 模式, 逐行写入), 否则使用 pandas 默认引擎
+    """
+
+    formats = {".xlsx": "xlsx", ".csv": "csv", ".parquet": "parquet"}
+
+    datetime_format = "yyyy-mm-dd hh:mm:ss"
+
+    def __init__(self, fmt: Optional[str] = None, engine: Optional[str] = None):
+        if fmt is not None and fmt not in self.formats.values():
+            raise ValueError(f"Unknown output format: {fmt}")
+
+        self.fmt = fmt
+        self.engine = engine or self.default_engine()
+
+    @staticmethod
+    def default_engine() -> str:
+        try:
+            import xlsxwriter  # noqa: F401
+        except ImportError:
+            return "openpyxl"
+
+        return "xlsxwriter"
+
+    def format_for(self, path: str) -> str:
+        if self.fmt is not None:
+            return self.fmt
+
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in self.formats:
+            raise ValueError(f"Unknown output format for {path}")
+
+        return self.formats[ext]
+
+    def extension(self) -> str:
+        """
+        :return: 输出文件的扩展名, 未指定格式时为 .xlsx
+        """
+        fmt = self.fmt or "xlsx"
+        return next(ext for ext, f in self.formats.items() if f == fmt)
+
+    def write(self, df: pd.DataFrame, path: str, amount_cols: Iterable[str] = ()):
+        """
+        :param df: 计算结果
+        :param path: 输出路径
+        :param amount_cols: 金额列, 值为 Decimal 或 "0", 输出 parquet 时转换为 decimal 类型
+        """
+        fmt = self.format_for(path)
+        if fmt == "csv":
+            self.write_csv(df, path)
+        elif fmt == "parquet":
+            self.write_parquet(df, path, amount_cols)
+        elif self.engine == "xlsxwriter":
+            self.write_xlsxwriter(df, path)
+        else:
+            df.to_excel(path, engine=self.engine)
+
+    def write_xlsxwriter(self, df: pd.DataFrame, path: str):
+        """
+        按行写入, constant_memory 模式下已写入的行不再保留在内存中
+        pandas 按列写入单元格, 不能使用 constant_memory, 因此直接使用 xlsxwriter
+        布局与 `DataFrame.to_excel` 一致: 第一行为表头, 第一列为 index
+        """
+        import xlsxwriter
+
+        wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+        ws = wb.add_worksheet("Sheet1")
+        date = wb.add_format({"num_format": self.datetime_format})
+
+        for c, name in enumerate(df.columns, 1):
+            ws.write_string(0, c, str(name))
+
+        for r, (index, values) in enumerate(
+            zip(df.index, df.itertuples(index=False, name=None)), 1
+        ):
+            ws.write(r, 0, index)
+            for c, value in enumerate(values, 1):
+                if is_null(value):
+                    continue
+                if isinstance(value, datetime):
+                    ws.write_datetime(r, c, value, date)
+                else:
+                    ws.write(r, c, value)
+
+        wb.close()
+
+    @staticmethod
+    def write_csv(df: pd.DataFrame, path: str):
+        # 带 BOM, excel 可以直接打开中文表头
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+
+    @staticmethod
+    def write_parquet(df: pd.DataFrame, path: str, amount_cols: Iterable[str] = ()):
+        import pandas as pd
+
+        df = df.copy()
+        for col in amount_cols:
+            df[col] = [None if v == "" else Decimal(v) for v in df[col]]
+
+        # parquet 每列只能有一种类型, 其余混合类型的列输出为字符串
+        for col in df.columns:
+            if col in amount_cols or df[col].dtype != object:
+                continue
+
+            types = {type(v) for v in df[col] if not pd.isnull(v)}
+            if len(types) > 1:
+                df[col] = [None if pd.isnull(v) else str(v) for v in df[col]]
+
+        df.to_parquet(path, index=False)
+
+
+class ResultStore:
+    """
+    用于增量计算, 以行指纹为键保存每行的计算结果 (sqlite)
+    path: 数据库路径
+    """
+
+    # sqlite 单条语句的参数个数有限, 分批查询
+    batch_size = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (fingerprint TEXT PRIMARY KEY, data BLOB)"
+        )
+
+    def get_many(self, fingerprints: Iterable[str]) -> Dict[str, dict]:
+        fingerprints = list(fingerprints)
+        res = {}
+        for i in range(0, len(fingerprints), self.batch_size):
+            batch = fingerprints[i : i + self.batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.conn.execute(
+                f"SELECT fingerprint, data FROM results WHERE fingerprint IN ({placeholders})",
+                batch,
+            )
+            for fingerprint, data in cursor:
+                res[fingerprint] = pickle.loads(data)
+
+        return res
+
+    def put_many(self, items: Iterable[Tuple[str, dict]]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (fingerprint, data) VALUES (?, ?)",
+                (
+                    (fingerprint, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+                    for fingerprint, data in items
+                ),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class CostTotals:
+    """
+    计算时累加公司与员工缴纳的保费, 按产品、auto_code 与 `group_cols` 汇总, 不需要再读取输出的表格
+    group_cols: 另外分组的列, 如部门
+    """
+
+    products = ("PCA", "ADD", "WMP", "TL", "HI", "AKDD")
+
+    def __init__(self, group_cols: Iterable[str] = ()):
+        self.group_cols = tuple(group_cols)
+        # 按 (auto_code, *分组列的值) 累加, 汇总时再合并, 每行只查找一次
+        # {键: [行数, {前缀: [公司, 员工]}]}
+        self.cells = {}
+
+    def add(self, res: dict, auto_code, groups: tuple = ()):
+        """
+        :param res: 一行的计算结果, 见 `cost_plan`
+        :param auto_code: 该行的 auto_code
+        :param groups: 该行 `group_cols` 的值
+        """
+        key = tuple(None if is_null(v) else v for v in (auto_code,) + groups)
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = [
+                0,
+                {pre: [Decimal(0), Decimal(0)] for pre in self.products},
+            ]
+
+        cell[0] += 1
+        for pre, sums in cell[1].items():
+            company = Decimal(res[f"{pre}_for_com"])
+            employee = Decimal(res[f"{pre}_for_emy"])
+            # 保费单元格为空时结果为 Decimal("NaN"), 与输出中的空单元格一样不计入
+            if company.is_finite():
+                sums[0] += company
+            if employee.is_finite():
+                sums[1] += employee
+
+    @staticmethod
+    def amount(value: Decimal) -> Decimal:
+        """
+        累加时保留原值, 输出时保留两位小数 (PCA / HI 不重新计算时结果为表格中的原值, 不止两位)
+        """
+        return value.quantize(Decimal("0.01"), ROUND_HALF_UP)
+
+    def rollup(self, i: Optional[int]) -> dict:
+        """
+        :param i: 按键的第 `i` 项合并, 为 None 时合并全部
+        :return: {值: [行数, {前缀: [公司, 员工]}]}
+        """
+        res = {}
+        for key, (rows, sums) in self.cells.items():
+            value = None if i is None else key[i]
+            total = res.setdefault(
+                value, [0, {pre: [Decimal(0), Decimal(0)] for pre in self.products}]
+            )
+            total[0] += rows
+            for pre, (company, employee) in sums.items():
+                total[1][pre][0] += company
+                total[1][pre][1] += employee
+
+        return res
+
+    def groups(self) -> List[Tuple[str, dict]]:
+        """
+        :return: [(分组名, `rollup` 的结果), ...], 分组名为 "total"、"auto_code" 与 `group_cols`
+        """
+        res = [("total", self.rollup(None)), ("auto_code", self.rollup(0))]
+        for i, col in enumerate(self.group_cols, 1):
+            res.append((col, self.rollup(i)))
+
+        return res
+
+    def records(self) -> List[dict]:
+        """
+        :return: 每个分组值、每个产品一行, 金额为两位小数的 Decimal
+        """
+        res = []
+        for group, totals in self.groups():
+            for value, (rows, sums) in totals.items():
+                for pre, (company, employee) in sums.items():
+                    res.append(
+                        {
+                            "group": group,
+                            "value": value,
+                            "product": pre,
+                            "rows": rows,
+                            "for_com": self.amount(company),
+                            "for_emy": self.amount(employee),
+                        }
+                    )
+
+        return res
+
+    def to_dict(self) -> dict:
+        """
+        :return: {分组名: {值: {"rows": 行数, "products": {前缀: {"for_com": 金额, "for_emy": 金额}}}}},
+        可以直接输出为 JSON, 金额为字符串
+        """
+        return {
+            group: {
+                ("" if value is None else str(value)): {
+                    "rows": rows,
+                    "products": {
+                        pre: {
+                            "for_com": str(self.amount(company)),
+                            "for_emy": str(self.amount(employee)),
+                        }
+                        for pre, (company, employee) in sums.items()
+                    },
+                }
+                for value, (rows, sums) in totals.items()
+            }
+            for group, totals in self.groups()
+        }
+
+    def write(self, path: str, writer: ResultWriter = None):
+        """
+        :param path: 输出路径, .json 输出 `to_dict`, 其余格式每行一条 `records`, 见 `ResultWriter`
+        """
+        if path.lower().endswith(".json"):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+            return
+
+        import pandas as pd
+
+        df = pd.DataFrame(
+            self.records(),
+            columns=["group", "value", "product", "rows", "for_com", "for_emy"],
+        )
+        (writer or ResultWriter()).write(df, path, ["for_com", "for_emy"])
+
+
+class ResultBuffer:
+    """
+    按列紧凑保存计算结果, 只在输出时展开
+    金额列保存为以分为单位的 int64 数组, 其余列 (名称、公式) 相同的值只保存一份
+    columns: 保存的列名, 即 `cost_plan` 结果的键
+    amount_cols: 其中的金额列
+
+    展开后的值与原值完全相同: 0 / "0" 不会变成 Decimal("0.00"),
+    不是两位小数的金额 (如不重新计算时 PCA / HI 的原值) 也保持原样
+    """
+
+    # 金额列中小于 `limit` 的值不是分, 而是 `table` 中第 (值 - `base`) 个值
+    base = -(2**63)
+    limit = -(2**63) + 2**32
+
+    def __init__(self, columns: Iterable[str], amount_cols: Iterable[str]):
+        amount_cols = set(amount_cols)
+        self.amounts = {c: array("q") for c in columns if c in amount_cols}
+        self.values = {c: array("L") for c in columns if c not in amount_cols}
+        # 不同的值只保存一份: {键: 编号}, 按编号排列的值
+        self.ids = {}
+        self.table = []
+        self.rows = 0
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def intern(self, value) -> int:
+        if type(value) is str:
+            key = value
+        else:
+            # 0 与 "0"、Decimal("1.2") 与 Decimal("1.20") 需要区分
+            key = (type(value), str(value) if isinstance(value, Decimal) else value)
+
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.table)
+            self.table.append(value)
+
+        return i
+
+    def cents(self, value) -> int:
+        """
+        :return: 两位小数的 Decimal 为以分为单位的金额, 其余为 `base` + `intern` 的编号
+        """
+        if isinstance(value, Decimal):
+            s = str(value)
+            # 两位小数时字符串总是 "整数部分.两位", 不会是科学计数法; 负零展开后无法还原符号
+            if s[-3:-2] == "." and s != "-0.00":
+                cents = int(s[:-3] + s[-2:])
+                if self.limit <= cents < 2**63:
+                    return cents
+
+        return self.base + self.intern(value)
+
+    def append(self, res: dict):
+        """
+        :param res: 一行的计算结果, 见 `cost_plan`
+        """
+        for name, column in self.amounts.items():
+            column.append(self.cents(res[name]))
+
+        # 每行十几次, 已出现过的字符串直接查找
+        ids = self.ids
+        for name, column in self.values.items():
+            value = res[name]
+            i = ids.get(value) if type(value) is str else None
+            column.append(self.intern(value) if i is None else i)
+
+        self.rows += 1
+
+    def column(self, name: str) -> list:
+        """
+        展开一列, 值与 `append` 时相同
+        """
+        table = self.table
+        if name in self.values:
+            return [table[i] for i in self.values[name]]
+
+        # 相同的金额共用一个 Decimal
+        expanded = {}
+        res = []
+        for cents in self.amounts[name]:
+            value = expanded.get(cents)
+            if value is None:
+                if cents < self.limit:
+                    value = table[cents - self.base]
+                else:
+                    value = Decimal(cents).scaleb(-2)
+                expanded[cents] = value
+
+            res.append(value)
+
+        return res
+
+
 class AutoNameHandler:
     """
     用于将 excel 中文字信息转换为接口可以识别的信息
@@ -25,17 +852,43 @@ class AutoNameHandler:
         SPOUSE = "sps"
         CHILD = "chd"
 
+    def __init__(self, cache_size: int = 1024):
+        self.cache_size = cache_size
+        # 预先解析的名称
+        self.resolved = {}
+        # 未预先解析的名称最多缓存 `cache_size` 个
+        self.cached_parse = lru_cache(maxsize=cache_size)(self.parse)
+
+    def __getstate__(self):
+        # lru_cache 无法 pickle, 传给子进程时只保留预先解析的名称
+        return {"cache_size": self.cache_size, "resolved": self.resolved}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_size"])
+        self.resolved = state["resolved"]
+
     @staticmethod
     def contains(target_str: str, pattern: str) -> bool:
         if target_str is None:
             return False
 
-        if re.search(rf".*?{pattern}.*?", target_str) is not None:
-            return True
+        return pattern in target_str
 
-        return False
+    def preload(self, auto_names):
+        """
+        预先解析名称, 之后 `handle` 对这些名称只做字典查找
+        """
+        for auto_name in auto_names:
+            if auto_name not in self.resolved:
+                self.resolved[auto_name] = self.parse(auto_name)
 
     def handle(self, auto_name: str) -> Tuple[str, int]:
+        try:
+            return self.resolved[auto_name]
+        except KeyError:
+            return self.cached_parse(auto_name)
+
+    def parse(self, auto_name: str) -> Tuple[str, int]:
         if self.contains(auto_name, "子女"):
             type_ = self.Type.CHILD
 
@@ -106,9 +959,37 @@ class AutoNameHandler:
 class AutoMapHandler:
     """
     用于从 auto 表中读取所有 auto_code 与名称对应关系
+    path: auto 表路径
+    cache: 是否使用缓存, 解析结果缓存在 `{path}.cache`, auto 表内容变化时自动重新解析
     """
 
-    def __init__(self):
+    # 缓存格式变化时修改
+    cache_version = 1
+
+    def __init__(
+        self, loader: WorkbookLoader = None, path: str = "auto.xlsx", cache: bool = True
+    ):
+        self.path = path
+        self.cache_path = f"{path}.cache"
+
+        self.auto_map = {}
+        # 通过 `compile` 生成
+        self.plans = {}
+        self.default_plan = None
+        self.name_handler = AutoNameHandler()
+
+        if cache and self.load_cache():
+            return
+
+        self.auto_map = self.read(loader or WorkbookLoader())
+        # 计划中出现的名称数量有限, 读取时全部解析
+        for names in self.auto_map.values():
+            self.name_handler.preload(v for k, v in names.items() if k != "name")
+
+        if cache:
+            self.dump_cache()
+
+    def read(self, loader: WorkbookLoader) -> dict:
         auto_code = "组合计划"
         auto_name = "组合计划名称"
         auto_tl = "定寿"
@@ -118,12 +999,12 @@ class AutoMapHandler:
         auto_pca = "交通意外"
         auto_hi = "住院津贴"
 
-        self.auto_map = {}
-        df = pd.read_excel("auto.xlsx", header=0, sheet_name="Sheet2")
+        auto_map = {}
+        df = loader.read(self.path, sheet_name="Sheet2", header=0)
         row_num = df.shape[0]
 
         for r in range(row_num):
-            self.auto_map[df[auto_code][r]] = {
+            auto_map[df[auto_code][r]] = {
                 "name": self.none_handler(df[auto_name][r]),
                 "tl": self.none_handler(df[auto_tl][r]),
                 "add": self.none_handler(df[auto_add][r]),
@@ -133,12 +1014,78 @@ class AutoMapHandler:
                 "hi": self.none_handler(df[auto_hi][r]),
             }
 
+        return auto_map
+
+    def file_hash(self) -> str:
+        h = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    def load_cache(self) -> bool:
+        """
+        读取缓存
+        路径与 mtime 均未变化, 或文件内容 hash 未变化时缓存有效
+        只有 mtime 变化时 (如重新保存、复制) 更新缓存中的 mtime, 之后不必再计算 hash
+        :return: 缓存是否有效
+        """
+        try:
+            with open(self.cache_path, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            # 缓存不存在或已损坏, 重新解析即可
+            return False
+
+        stat = os.stat(self.path)
+        if data.get("version") != self.cache_version:
+            return False
+
+        if data["path"] != os.path.abspath(self.path):
+            return False
+
+        stale = (data["mtime"], data["size"]) != (stat.st_mtime_ns, stat.st_size)
+        if stale and data["hash"] != self.file_hash():
+            return False
+
+        self.auto_map = data["auto_map"]
+        self.name_handler.resolved = data["resolved"]
+        if stale:
+            self.dump_cache(data["hash"])
+        return True
+
+    def dump_cache(self, file_hash: str = None):
+        """
+        :param file_hash: 已计算的文件内容 hash, 为 None 时重新计算
+        """
+        stat = os.stat(self.path)
+        data = {
+            "version": self.cache_version,
+            "path": os.path.abspath(self.path),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": file_hash or self.file_hash(),
+            "auto_map": self.auto_map,
+            "resolved": self.name_handler.resolved,
+        }
+
+        # 先写临时文件再替换, 避免并发运行时读到写了一半的缓存
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # 目录不可写时不使用缓存
+            pass
+
     @staticmethod
     def none_handler(target):
         if target == " ":
             return None
 
-        if pd.isnull(target):
+        if is_null(target):
             return None
 
         return target
@@ -157,39 +1104,379 @@ class AutoMapHandler:
             },
         )
 
+    def compile_plan(self, names: dict, calculator: CostCalculator) -> dict:
+        """
+        解析一个计划的各产品名称, 并记下费率表中缺少倍率/保费/保额的产品 (见 `count_plan`)
+        :param names: `get_auto_name` 的结果
+        :param calculator: 提供费率表的计算器
+        :return: {"names": names, 产品: (类型, 等级), ..., "zero": 缺少倍率/保费/保额的产品}
+        """
+        return self.build_plan(names, self.name_handler, calculator)
+
+    @staticmethod
+    def build_plan(
+        names: dict, name_handler: AutoNameHandler, calculator: CostCalculator
+    ) -> dict:
+        """
+        `compile_plan` 的实现, 不需要读取 auto 表, 见 `quote.py`
+        """
+        c = calculator
+        wmp_cost = {
+            CostCalculator.Type.EMPLOYEE: c.wmp_emy_cost,
+            CostCalculator.Type.SPOUSE: c.wmp_sps_cost,
+            CostCalculator.Type.CHILD: c.wmp_chd_cost,
+        }
+
+        add_type, add_level = name_handler.handle(names["add"])
+        wmp_type, wmp_level = name_handler.handle(names["wmp"])
+        tl_type, tl_level = name_handler.handle(names["tl"])
+        # AKDD 等级取自住院津贴名称
+        akdd_type, akdd_level = name_handler.handle(names["hi"])
+
+        values = {
+            "add": c.add_mag.get(add_level),
+            "wmp": wmp_cost.get(wmp_type, {}).get(wmp_level),
+            "tl": c.tl_mag.get(tl_level),
+            "akdd": c.akdd_amount.get(akdd_level),
+        }
+        return {
+            "names": names,
+            "add": (add_type, add_level),
+            "wmp": (wmp_type, wmp_level),
+            "tl": (tl_type, tl_level),
+            "akdd": (akdd_type, akdd_level),
+            "zero": tuple(p for p, value in values.items() if value is None),
+        }
+
+    def compile(self, calculator: CostCalculator) -> dict:
+        """
+        为所有 auto_code 预先生成计划, 之后每行只需一次字典查找
+        结果只包含 str / int / Decimal, 可以直接序列化 (pickle)
+        :param calculator: 提供费率表的计算器
+        :return: {auto_code: plan}
+        """
+        self.plans = {
+            auto_code: self.compile_plan(names, calculator)
+            for auto_code, names in self.auto_map.items()
+        }
+        self.default_plan = self.compile_plan(self.get_auto_name(None), calculator)
+        return self.plans
+
+    def get_plan(self, auto_code) -> dict:
+        return self.plans.get(auto_code, self.default_plan)
+
+
+class SalaryChanges:
+    """
+    工资变动记录, 按员工分组并按日期排序, 用于将缴纳期间按工资变动拆分为多段
+    records: [(员工, 变动生效日期, 变动后工资), ...]
+    """
+
+    def __init__(self, records: Iterable[Tuple[object, datetime, Decimal]]):
+        # 排序后一次遍历分组, 总耗时与记录数成线性 (不计排序)
+        self.changes = {}
+        for key, date, salary in sorted(records, key=lambda r: (r[0], r[1])):
+            dates, salaries = self.changes.setdefault(key, ([], []))
+            dates.append(date)
+            salaries.append(salary)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pd.DataFrame,
+        key: str = "客户姓名",
+        date: str = "生效日期",
+        salary: str = "工资",
+    ) -> "SalaryChanges":
+        """
+        :param df: 工资变动 sheet, 每行一条记录
+        :param key: 员工列, 与花名册中的值相同
+        :param date: 变动生效日期列
+        :param salary: 变动后工资列
+        """
+        import pandas as pd
+
+        dates = pd.to_datetime(df[date], format="%Y/%m/%d", errors="coerce")
+        bad = dates.isna()
+        if bad.any():
+            rows = ", ".join(str(r + 2) for r in df.index[bad])
+            raise ValueError(f"Can't parse salary change dates in rows: {rows}")
+
+        return cls(
+            zip(
+                df[key].tolist(),
+                dates.dt.to_pydatetime().tolist(),
+                [ExcelHandler.to_decimal(s) for s in df[salary].tolist()],
+            )
+        )
+
+    def __contains__(self, key) -> bool:
+        return key in self.changes
+
+    def segments(
+        self, key, start: datetime, stop: datetime, salary: Decimal
+    ) -> List[Tuple[Decimal, Decimal]]:
+        """
+        按工资变动拆分 `start` 至 `stop`, 没有变动记录时只有一段
+        :param salary: 花名册中的工资, 用于第一条变动之前
+        :return: [(工资, 天数), ...], 即 `CostCalculator.cal_add` 的 `salary_list`
+        """
+        dates, salaries = self.changes.get(key, ((), ()))
+        # `start` 当天及之前的变动决定第一段的工资
+        i = bisect.bisect_right(dates, start)
+        if i:
+            salary = salaries[i - 1]
+
+        res = []
+        current = start
+        for date, new_salary in zip(dates[i:], salaries[i:]):
+            if date >= stop:
+                break
+
+            res.append((salary, Decimal((date - current).days)))
+            current = date
+            salary = new_salary
+
+        res.append((salary, Decimal((stop - current).days)))
+        # 同一天的多条变动只保留最后一条
+        return [s for s in res if s[1]] or res[-1:]
+
+
+class Schema:
+    """
+    表格格式: 表头所在的行, 以及各字段对应的列
+    fields: {字段: 列}, 列为合并后的表头 (见 `WorkbookLoader.header_handler`),
+    或 {"pattern": 正则, "occurrence": 第几个匹配的列 (从 0 开始)}, 未指定的字段使用 `default`
+    header_from: header 起始行 (从 1 开始)
+    header_to: header 结束行
+
+    文件格式为 JSON (安装了 PyYAML 时也可以是 YAML):
+    {"header_from": 1, "header_to": 2, "fields": {"add_cost": {"pattern": "^保费", "occurrence": 1}}}
+    """
+
+    default = {
+        "name": "客户姓名",
+        "start": "生效日期",
+        "stop": "终止日期",
+        "salary": "工资",
+        "auto_code": "计划",
+        "pca_amount": "PCA_B保额",
+        "pca_cost": "保费",
+        "add_amount": "ADD_B保额",
+        "add_cost": "保费.1",
+        "wmp_amount": "WMP-HL1保额",
+        "wmp_cost": "保费.2",
+        "tl_amount": "TL保额",
+        "tl_cost": "保费.5",
+        "hi_amount": "HI保额",
+        "hi_cost": "保费.6",
+        "akdd_amount": "AKDD保额",
+        "akdd_cost": "AKDD保额",
+    }
+
+    def __init__(self, fields: dict = None, header_from: int = 1, header_to: int = 2):
+        unknown = set(fields or {}) - set(self.default)
+        if unknown:
+            raise ValueError(f"Unknown schema fields: {', '.join(sorted(unknown))}")
+        if not 1 <= header_from <= header_to:
+            raise ValueError(f"Bad header rows: {header_from}-{header_to}")
+
+        self.fields = {**self.default, **(fields or {})}
+        self.header_from = header_from
+        self.header_to = header_to
+
+    @classmethod
+    def from_file(cls, path: str) -> "Schema":
+        with open(path, encoding="utf-8") as f:
+            if path.endswith((".yaml", ".yml")):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ValueError(f"PyYAML is required to read {path}")
+
+                data = yaml.safe_load(f)
+            else:
+                data = json.load(f)
+
+        return cls(
+            data.get("fields"), data.get("header_from", 1), data.get("header_to", 2)
+        )
+
+    @staticmethod
+    def find(headers: List[str], spec) -> Optional[int]:
+        """
+        :return: `spec` 对应的列位置, 找不到时为 None
+        """
+        if isinstance(spec, str):
+            return headers.index(spec) if spec in headers else None
+
+        pattern = re.compile(spec["pattern"])
+        matches = [i for i, h in enumerate(headers) if pattern.search(h)]
+        occurrence = spec.get("occurrence", 0)
+        return matches[occurrence] if occurrence < len(matches) else None
+
+    def resolve(self, headers: List[str]) -> Dict[str, int]:
+        """
+        每张表只解析一次
+        :param headers: 合并后的表头
+        :return: {字段: 列位置}
+        """
+        positions = {}
+        missing = []
+        for field, spec in self.fields.items():
+            pos = self.find(headers, spec)
+            if pos is None:
+                missing.append(f"{field} ({spec!r})")
+            else:
+                positions[field] = pos
+
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+        return positions
+
 
 class ExcelHandler:
-    def __init__(self):
-        self.header_from = 1
-        self.header_to = 2
-        self.excel_path = "sample1.xlsx"
-
-        self.start = "生效日期"
-        self.stop = "终止日期"
-        self.salary = "工资"
-        self.auto_code = "计划"
-
-        self.pca_amount = "PCA_B保额"
-        self.pca_cost = "保费"
-        self.add_amount = "ADD_B保额"
-        self.add_cost = "保费.1"
-        self.wmp_amount = "WMP-HL1保额"
-        self.wmp_cost = "保费.2"
-        self.tl_amount = "TL保额"
-        self.tl_cost = "保费.5"
-        self.hi_amount = "HI保额"
-        self.hi_cost = "保费.6"
-        self.akdd_amount = "AKDD保额"
-        self.akdd_cost = "AKDD保额"
-
-        headers = self.header_handler(self.header_from, self.header_to)
-        # 截掉标题后 index 从 `self.header_to` 开始记
-        self.df = pd.read_excel(self.excel_path, header=None, names=headers).loc[
-            self.header_to :
-        ]
+    """
+    excel_path: 待计算的表格
+    auto_map: 已读取的计划表, 为 None 时读取 auto.xlsx
+    engine: excel 读取引擎, 见 `WorkbookLoader`
+    with_formula: 是否输出计算公式, 关闭时 `*_formula` 列为空, 为 None 时与 `calculator` 一致 (默认输出)
+    instrument: 运行统计, 见 `Instrument`
+    verbose: 是否逐行打印姓名
+    writer: 结果输出方式, 见 `ResultWriter`
+    rate_card: 费率表文件, 见 `CostCalculator.read_rates`
+    calculator: 已创建的计算器, 为 None 时由 `rate_card` 创建
+    salary_sheet: 工资变动记录所在的 sheet, 有记录的员工按变动拆分工资, 为 None 时不拆分
+    skip_invalid: 是否跳过未通过检查的行 (见 `validate`), 为 False 时有这样的行则在计算前报错
+    schema: 表头所在的行与各字段对应的列, 见 `Schema`, 为 None 时使用默认格式
+    """
 
-        self.auto_map = AutoMapHandler()
-        self.name_handler = AutoNameHandler()
+    # 计算时读取的字段, 按此顺序取出各行的值 (见 `input_values`)
+    input_fields = (
+        "name",
+        "start",
+        "stop",
+        "salary",
+        "auto_code",
+        "pca_cost",
+        "hi_cost",
+    )
+
+    # 费率对应天数
+    days_of_year = 365 - 31
+
+    def __init__(
+        self,
+        excel_path: str = "sample1.xlsx",
+        auto_map: AutoMapHandler = None,
+        engine: Optional[str] = None,
+        with_formula: Optional[bool] = None,
+        instrument: Instrument = None,
+        verbose: bool = False,
+        writer: ResultWriter = None,
+        rate_card: str = "rates.json",
+        calculator: CostCalculator = None,
+        salary_sheet: Optional[str] = None,
+        skip_invalid: bool = False,
+        schema: Schema = None,
+    ):
+        self.instrument = instrument or Instrument()
+        self.instrument.start()
+        self.verbose = verbose
+        self.schema = schema or Schema()
+        self.header_from = self.schema.header_from
+        self.header_to = self.schema.header_to
+        self.excel_path = excel_path
+
+        self.loader = WorkbookLoader(engine)
+        self.writer = writer or ResultWriter()
+        with self.instrument.stage("load"):
+            self.df = self.load()
+
+        with self.instrument.stage("auto_map"):
+            self.auto_map = auto_map or AutoMapHandler(self.loader)
+            self.name_handler = self.auto_map.name_handler
+
+        self.salary_sheet = salary_sheet
+        self.salary_changes = None
+        # 流式处理时读取表头后再解析, 见 `StreamingExcelHandler`
+        if self.df is not None:
+            self.apply_schema(list(self.df.columns))
+            with self.instrument.stage("salary_changes"):
+                self.salary_changes = self.load_salary_changes()
+
+        # 增量计算的命中情况, 见 `handle_rows_incremental`
+        self.incremental_stats = None
+        self.skip_invalid = skip_invalid
+        # 未通过检查的行, 见 `validate`
+        self.rejected = []
+        # 计算的行数
+        self.rows = 0
+
+        # 整张表共用一个计算器, 每天的费率只计算一次
+        if calculator is None:
+            calculator = CostCalculator.from_file(
+                rate_card,
+                days_of_year=self.days_of_year,
+                with_formula=True if with_formula is None else with_formula,
+            )
+        elif with_formula is not None and with_formula != calculator.with_formula:
+            raise ValueError(
+                f"with_formula={with_formula} conflicts with the calculator "
+                f"(with_formula={calculator.with_formula})"
+            )
+
+        self.calculator = calculator
+        self.with_formula = calculator.with_formula
+        # 整张表按列计算时使用, 费率表与 `calculator` 相同
+        self.batch = BatchCostCalculator.from_calculator(calculator)
+        with self.instrument.stage("compile"):
+            self.auto_map.compile(self.calculator)
+
+    def apply_schema(self, headers: List[str]):
+        """
+        将 `self.schema` 解析为列位置, 并把各字段对应的列名设为同名属性 (如 `self.start`)
+        :param headers: 合并后的表头
+        """
+        self.positions = self.schema.resolve(headers)
+        for field, pos in self.positions.items():
+            setattr(self, field, headers[pos])
+
+        # 产品表: (前缀, `*_type` 列插入在该列之前, 计算结果列插入在该列之后)
+        self.products = (
+            ("PCA", self.pca_amount, self.pca_cost),
+            ("ADD", self.add_amount, self.add_cost),
+            ("WMP", self.wmp_amount, self.wmp_cost),
+            ("TL", self.tl_amount, self.tl_cost),
+            ("HI", self.hi_amount, self.hi_cost),
+            ("AKDD", self.hi_amount, self.akdd_cost),
+        )
+
+    def load(self) -> pd.DataFrame:
+        # 截掉标题后 index 从 `self.header_to` 开始记, 整行为空的行不是数据, 直接跳过
+        _, df = self.loader.load(self.excel_path, self.header_from, self.header_to)
+        return df.dropna(how="all")
+
+    def load_salary_changes(self) -> Optional[SalaryChanges]:
+        if self.salary_sheet is None:
+            return None
+
+        df = self.loader.read(self.excel_path, self.salary_sheet)
+        return SalaryChanges.from_frame(df, self.name, self.start, self.salary)
+
+    def salary_list(self, values: tuple) -> Optional[List[tuple]]:
+        """
+        :param values: 一行中 `input_fields` 的值
+        :return: 该员工有工资变动记录时为按变动拆分的 [(工资, 天数), ...], 否则为 None
+        """
+        name, start, stop, salary = values[:4]
+        if self.salary_changes is None or name not in self.salary_changes:
+            return None
+
+        return self.salary_changes.segments(
+            name, parse_date(start), parse_date(stop), self.to_decimal(salary)
+        )
 
     @staticmethod
     def to_decimal(num_str):
@@ -199,143 +1486,614 @@ class ExcelHandler:
         except InvalidOperation:
             return Decimal(0)
 
-    def header_handler(self, start: int, end: int) -> List[str]:
+    def output_columns(
+        self, inserts: List[Tuple[str, str, bool]], cols: List[str] = None
+    ) -> List[str]:
         """
-        用于将多行索引(mutiindex) 转换为单行索引
-        :param start: header 起始行 (从 1 开始
-        :param end: header 起始行
+        计算依次插入新列后的列顺序 (不修改 `self.df`)
+        :param inserts: [(`target_col`, `name`, `after`), ...], 规则同 `add_new_col`
+        :param cols: 插入前的列, 默认为 `self.df` 的列
         :return:
         """
-        # TODO: handle all header
-        nrows = end
-        df = pd.read_excel(
-            self.excel_path, header=None, nrows=nrows, keep_default_na=False
-        )
-        headers = []
+        cols = list(self.df) if cols is None else cols
+        for target_col, name, after in inserts:
+            try:
+                i = cols.index(target_col)
+            except ValueError:
+                raise ValueError(f"Can't find {target_col}, choices are {cols}")
 
-        ncols = df.columns.size
-        for c in range(ncols):
-            header = []
-            for r in range(nrows):
-                header.append(df[c][start - 1 + r])
+            index = i if not after else i + 1
+            cols.insert(index, name)
 
-            headers.append("".join(header))
+        return cols
 
-        return headers
+    def add_new_cols(self, inserts: List[Tuple[str, str, bool]]):
+        """
+        依次插入多个新列, 只对 `self.df` 做一次 reindex
+        :param inserts: [(`target_col`, `name`, `after`), ...], 规则同 `add_new_col`
+        """
+        cols = self.output_columns(inserts)
+        self.df = self.df.reindex(columns=cols, fill_value="")
+        return
 
     def add_new_col(self, target_col, name, after: bool = False):
         """
         `after = True`: 在 `target_col` 之后插入名为 `name` 的列
         `after = False`: 在 `target_col` 之前插入名为 `name` 的列
         """
-        self.df[name] = ""
-        cols = list(self.df)
+        self.add_new_cols([(target_col, name, after)])
+        return
 
-        try:
-            i = cols.index(target_col)
-        except ValueError:
-            raise ValueError(f"Can't find {target_col}, choices are {cols}")
+    def output_inserts(self) -> List[Tuple[str, str, bool]]:
+        """
+        需要插入的新列
+        :return: [(`target_col`, `name`, `after`), ...]
+        """
+        inserts = []
+        for pre, type_tar, _ in self.products:
+            inserts.append((type_tar, f"{pre}_type", False))
+
+        for pre, _, tar in self.products:
+            for c in ("emy_formula", "for_emy", "com_formula", "for_com"):
+                inserts.append((tar, f"{pre}_{c}", True))
 
-        index = i if not after else i + 1
+        return inserts
 
-        cols.pop()
-        cols.insert(index, name)
-        self.df = self.df.loc[:, cols]
-        return
+    def insert_results(
+        self, inserts: List[Tuple[str, str, bool]], buffer: ResultBuffer
+    ):
+        """
+        插入新列并填入计算结果, 每次只展开 `buffer` 中的一列
+        :param inserts: 见 `output_inserts`
+        """
+        import pandas as pd
+
+        self.add_new_cols(inserts)
+        for _, name, _ in inserts:
+            self.df[name] = pd.Series(
+                buffer.column(name), index=self.df.index, dtype=object
+            )
+
+    def amount_columns(self) -> List[str]:
+        """
+        :return: 计算结果中的金额列
+        """
+        return [
+            f"{pre}_{c}" for pre, _, _ in self.products for c in ("for_emy", "for_com")
+        ]
+
+    def required_columns(self) -> List[str]:
+        cols = [
+            self.name,
+            self.start,
+            self.stop,
+            self.salary,
+            self.auto_code,
+            self.pca_cost,
+            self.hi_cost,
+        ]
+        for _, type_tar, tar in self.products:
+            cols += [type_tar, tar]
+
+        return list(dict.fromkeys(cols))
+
+    def parse_dates(self) -> Tuple[pd.Series, pd.Series]:
+        """
+        一次性解析整张表的起止日期, 供 `validate` 与 `active_days` 共用
+        :return: (生效日期, 终止日期), 无法解析的为 NaT
+        """
+        import pandas as pd
+
+        return tuple(
+            pd.to_datetime(self.df[col], format="%Y/%m/%d", errors="coerce")
+            for col in (self.start, self.stop)
+        )
+
+    @staticmethod
+    def rejection(r: int, column: str, value, reason: str) -> dict:
+        return {
+            "row": r + 1,
+            "column": column,
+            "value": None if is_null(value) else str(value),
+            "reason": reason,
+        }
+
+    @staticmethod
+    def invalid_rows_error(rejected: List[dict]) -> ValueError:
+        return ValueError(
+            "Invalid rows:\n"
+            + "\n".join(
+                f"row {r['row']}: {r['column']}={r['value']!r} ({r['reason']})"
+                for r in rejected
+            )
+        )
+
+    def validate(self, dates: Tuple[pd.Series, pd.Series] = None) -> List[dict]:
+        """
+        计算前按列一次检查整张表, 缺少必需的列时直接报错
+        日期无法解析、工资不是数字、保费不是数字 (空单元格除外)、auto_code 不在计划表中的行计入结果
+        :param dates: `parse_dates` 的结果, 为 None 时重新解析
+        :return: [{"row": excel 行号, "column": 列名, "value": 值, "reason": 原因}, ...], 按行号排序
+        """
+        import pandas as pd
+
+        missing = [c for c in self.required_columns() if c not in self.df.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+        checks = []
+        for col, parsed in zip((self.start, self.stop), dates or self.parse_dates()):
+            checks.append((col, parsed.isna(), "bad date"))
+
+        # 空的工资同样不是数字, 只有保费可以为空
+        for col, nullable in (
+            (self.salary, False),
+            (self.pca_cost, True),
+            (self.hi_cost, True),
+        ):
+            values = self.df[col]
+            bad = pd.to_numeric(values, errors="coerce").isna()
+            if nullable:
+                bad &= values.notna()
+            checks.append((col, bad, "not a number"))
+
+        codes = self.df[self.auto_code]
+        checks.append(
+            (
+                self.auto_code,
+                ~codes.isin(list(self.auto_map.plans)),
+                "unknown auto_code",
+            )
+        )
+
+        rejected = []
+        for col, bad, reason in checks:
+            for r in self.df.index[bad.to_numpy()]:
+                rejected.append(self.rejection(r, col, self.df.at[r, col], reason))
+
+        rejected.sort(key=lambda x: x["row"])
+        return rejected
+
+    def validate_row(self, r: int, values: tuple) -> List[dict]:
+        """
+        检查一行, 规则与顺序同 `validate`, 用于流式处理
+        :param r: 该行的 index, 即 excel 行号 - 1
+        :param values: 该行 `input_fields` 的值
+        """
+        _, start, stop, salary, auto_code, pca_cost, hi_cost = values
+        checks = [
+            (self.start, start, is_date(start), "bad date"),
+            (self.stop, stop, is_date(stop), "bad date"),
+            (self.salary, salary, is_number(salary), "not a number"),
+        ]
+        for col, value in (
+            (self.pca_cost, pca_cost),
+            (self.hi_cost, hi_cost),
+        ):
+            checks.append(
+                (col, value, is_null(value) or is_number(value), "not a number")
+            )
+
+        checks.append(
+            (
+                self.auto_code,
+                auto_code,
+                auto_code in self.auto_map.plans,
+                "unknown auto_code",
+            )
+        )
+        return [
+            self.rejection(r, col, value, reason)
+            for col, value, ok, reason in checks
+            if not ok
+        ]
+
+    def date_error(self, r: int, start, stop) -> str:
+        return f"row {r + 1}: {self.start}={start!r}, {self.stop}={stop!r}"
+
+    def active_days(
+        self, dates: Tuple[pd.Series, pd.Series] = None
+    ) -> Tuple[List[Optional[int]], List[str]]:
+        """
+        计算整张表的实际缴纳天数
+        :param dates: `parse_dates` 的结果, 为 None 时重新解析
+        :return: (每行实际缴纳天数, 无法解析的行), 无法解析的行天数为 None
+        """
+        start, stop = dates or self.parse_dates()
+        days = (stop - start).dt.days
+
+        bad = days.isna()
+        errors = [
+            self.date_error(r, self.df[self.start][r], self.df[self.stop][r])
+            for r in self.df.index[bad]
+        ]
+        return [None if b else int(d) for d, b in zip(days, bad)], errors
+
+    def input_values(self) -> List[tuple]:
+        """
+        按列位置一次取出整张表中 `input_fields` 的值
+        :return: 每行一个元组, 顺序同 `input_fields`
+        """
+        columns = [
+            self.df.iloc[:, self.positions[f]].to_numpy(dtype=object)
+            for f in self.input_fields
+        ]
+        return list(zip(*columns))
+
+    def handle_values(self, values: tuple, active_days: int = None) -> dict:
+        """
+        计算一行
+        :param values: 该行 `input_fields` 的值
+        :param active_days: 实际缴纳天数, 为 None 时由该行的起止日期计算
+        :return: {新列名: 值}
+        """
+        name, start, stop, salary, auto_code, pca_cost, hi_cost = values
+        if self.verbose:
+            print(f"name: {name}")
+
+        salary_de = self.to_decimal(salary)
+        pca_cost_de = self.to_decimal(pca_cost)
+        hi_cost_de = self.to_decimal(hi_cost)
+
+        if active_days is None:
+            active_days = (parse_date(stop) - parse_date(start)).days
+
+        # 通过 auto_code 填入名称
+        plan = self.auto_map.get_plan(auto_code)
+        return cost_plan(
+            self.calculator,
+            plan,
+            salary_de,
+            active_days,
+            pca_cost_de,
+            hi_cost_de,
+            self.salary_list(values),
+        )
+
+    def handle_batch(self, rows: List[tuple], active_days: List[int]) -> List[dict]:
+        """
+        按列计算多行, 结果与逐行调用 `handle_values` 一致, 见 `cost_plans`
+        :param rows: 各行 `input_fields` 的值
+        :param active_days: 各行实际缴纳天数
+        :return: 各行 {新列名: 值}
+        """
+        if self.verbose:
+            for values in rows:
+                print(f"name: {values[0]}")
+
+        to_decimal = self.to_decimal
+        return cost_plans(
+            self.batch,
+            [self.auto_map.get_plan(values[4]) for values in rows],
+            [to_decimal(values[3]) for values in rows],
+            active_days,
+            [to_decimal(values[5]) for values in rows],
+            [to_decimal(values[6]) for values in rows],
+            [self.salary_list(values) for values in rows],
+        )
+
+    def handle_rows(
+        self,
+        rows: List[tuple],
+        active_days: List[int],
+        workers: int = 1,
+        chunk_size: int = 10000,
+    ) -> List[dict]:
+        """
+        计算多行
+        :param rows: 各行 `input_fields` 的值, 见 `input_values`
+        :param active_days: 各行实际缴纳天数
+        :param workers: 进程数, 大于 1 时各块在子进程中计算
+        :param chunk_size: 每块行数, 每块由 `handle_batch` 按列计算
+        :return: 各行 `handle_values` 的结果, 顺序与 `rows` 一致
+        """
+        return list(self.iter_results(rows, active_days, workers, chunk_size))
+
+    def iter_results(
+        self,
+        rows: List[tuple],
+        active_days: List[int],
+        workers: int = 1,
+        chunk_size: int = 10000,
+    ) -> Iterator[dict]:
+        """
+        同 `handle_rows`, 逐块计算并逐行返回结果, 不同时保留全部行的结果
+        """
+        if workers <= 1:
+            for i in range(0, len(rows), chunk_size):
+                yield from self.handle_batch(
+                    rows[i : i + chunk_size], active_days[i : i + chunk_size]
+                )
+            return
+
+        handler = self.worker_copy()
+        pairs = list(zip(rows, active_days))
+        chunks = [pairs[i : i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_chunk_worker, initargs=(handler,)
+        ) as pool:
+            # `map` 按提交顺序返回, 拼接后与逐行计算顺序一致
+            for chunk in pool.map(_handle_chunk, chunks):
+                yield from chunk
+
+    def worker_copy(self) -> ExcelHandler:
+        """
+        发送给子进程的副本, 子进程只做计算, 不需要整张表与读写、统计对象 (cProfile 等无法 pickle)
+        """
+        handler = copy.copy(self)
+        handler.df = None
+        handler.instrument = None
+        handler.writer = None
+        handler.loader = None
+        return handler
+
+    def config_key(self) -> str:
+        """
+        计算配置 (计划表、费率、天数、是否输出公式) 的指纹, 配置变化时增量计算的结果全部失效
+        """
+        config = (
+            self.auto_map.plans,
+            self.auto_map.default_plan,
+            self.calculator.rates(),
+            self.calculator.days_of_year,
+            self.calculator.with_formula,
+        )
+        return hashlib.sha256(repr(config).encode()).hexdigest()
+
+    def fingerprint(self, values: tuple, config_key: str) -> str:
+        # 姓名只影响工资变动, 不计入指纹, 相同的行可以共用结果
+        key = (config_key,) + values[1:] + (self.salary_list(values),)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def handle_rows_incremental(
+        self,
+        rows: List[tuple],
+        active_days: List[int],
+        store: ResultStore,
+        workers: int = 1,
+        chunk_size: int = 10000,
+    ) -> List[dict]:
+        """
+        只计算 `store` 中没有的行, 其余行直接使用上次的结果
+        命中情况记录在 `self.incremental_stats`
+        :return: 同 `handle_rows`
+        """
+        config_key = self.config_key()
+        keys = [self.fingerprint(row, config_key) for row in rows]
+        cached = store.get_many(set(keys))
+
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        computed = self.handle_rows(
+            [rows[i] for i in missing],
+            [active_days[i] for i in missing],
+            workers,
+            chunk_size,
+        )
+        for i, res in zip(missing, computed):
+            cached[keys[i]] = res
+
+        store.put_many((keys[i], res) for i, res in zip(missing, computed))
+        self.incremental_stats = {
+            "hits": len(rows) - len(missing),
+            "recalculated": len(missing),
+        }
+        return [cached[key] for key in keys]
+
+    def count_plan(self, plan: dict):
+        """
+        统计各产品的计算行数, 因缺少倍率/保费/保额而结果为 0 的行计入 `zero`
+        """
+        self.instrument.count("PCA", "calculated")
+        self.instrument.count("HI", "calculated")
+        for pre, product in (
+            ("ADD", "add"),
+            ("WMP", "wmp"),
+            ("TL", "tl"),
+            ("AKDD", "akdd"),
+        ):
+            self.instrument.count(
+                pre, "zero" if product in plan["zero"] else "calculated"
+            )
+
+    @staticmethod
+    def check_group_cols(totals: CostTotals, headers: List[str]):
+        missing = [c for c in totals.group_cols if c not in headers]
+        if missing:
+            raise ValueError(f"Missing group columns: {', '.join(missing)}")
+
+    def report(self) -> dict:
+        """
+        :return: 运行统计, 可以直接输出为 JSON
+        """
+        res = self.instrument.report()
+        res["excel_path"] = self.excel_path
+        res["rows"] = self.rows
+        if self.incremental_stats is not None:
+            res["incremental"] = self.incremental_stats
+        if self.rejected:
+            res["rejected"] = self.rejected
+
+        return res
 
     def handle_excel(
         self,
+        output_path: str = "new.xlsx",
+        workers: int = 1,
+        chunk_size: int = 10000,
+        store: ResultStore = None,
+        totals: CostTotals = None,
     ):
-        row_start = self.header_to
-
-        row_num = self.df.shape[0]
-        ncols = self.df.columns.size
-
-        # 插入空白列
-        self.add_new_col(self.pca_amount, "PCA_type")
-        self.add_new_col(self.add_amount, "ADD_type")
-        self.add_new_col(self.wmp_amount, "WMP_type")
-        self.add_new_col(self.tl_amount, "TL_type")
-        self.add_new_col(self.hi_amount, "HI_type")
-        self.add_new_col(self.hi_amount, "AKDD_type")
-
-        for pre, tar in (
-            ("PCA", self.pca_cost),
-            ("ADD", self.add_cost),
-            ("WMP", self.wmp_cost),
-            ("TL", self.tl_cost),
-            ("HI", self.hi_cost),
-            ("AKDD", self.akdd_cost),
-        ):
-            for c in ("emy_formula", "for_emy", "com_formula", "for_com"):
-                name = f"{pre}_{c}"
-                self.add_new_col(tar, name, after=True)
-
-        for r in range(row_start, row_start + row_num):
-            print(f"name: {self.df['客户姓名'][r]}")
-            start = self.df[self.start][r]
-            stop = self.df[self.stop][r]
-            salary = self.df[self.salary][r]
-            salary_de = self.to_decimal(salary)
-            auto_code = self.df[self.auto_code][r]
-
-            pca_amount = self.df[self.pca_amount][r]
-            pca_cost = self.df[self.pca_cost][r]
-            add_amount = self.df[self.add_amount][r]
-            add_cost = self.df[self.add_cost][r]
-            wmp_amount = self.df[self.wmp_amount][r]
-            wmp_cost = self.df[self.wmp_cost][r]
-            tl_amount = self.df[self.tl_amount][r]
-            tl_cost = self.df[self.tl_cost][r]
-            hi_amount = self.df[self.hi_amount][r]
-            hi_cost = self.df[self.hi_cost][r]
-            akdd_amount = self.df[self.akdd_amount][r]
-            akdd_cost = self.df[self.akdd_cost][r]
-
-            pca_cost_de = self.to_decimal(pca_cost)
-            hi_cost_de = self.to_decimal(hi_cost)
-
-            active_days = (time_serialize(stop) - time_serialize(start)).days
-            active_days_de = self.to_decimal(active_days)
-
-            # 通过 auto_code 填入名称
-            auto_name_dict = self.auto_map.get_auto_name(auto_code)
-            self.df["PCA_type"][r] = auto_name_dict["pca"]
-            self.df["ADD_type"][r] = auto_name_dict["add"]
-            self.df["WMP_type"][r] = auto_name_dict["wmp"]
-            self.df["TL_type"][r] = auto_name_dict["tl"]
-            self.df["HI_type"][r] = auto_name_dict["hi"]
-            self.df["AKDD_type"][r] = auto_name_dict["akdd"]
-
-            # 计算
-            c = CostCalculator(active_days=active_days, days_of_year=365 - 31)
-
-            salary_list = [(salary_de, active_days_de)]
-
-            add_type, add_level = self.name_handler.handle(auto_name_dict["add"])
-            wmp_type, wmp_level = self.name_handler.handle(auto_name_dict["wmp"])
-            tl_type, tl_level = self.name_handler.handle(auto_name_dict["tl"])
-            _, akdd_level = self.name_handler.handle(auto_name_dict["hi"])
-
-            pca_data = c.cal_pca(pca_cost_de)
-            add_data = c.cal_add(add_type, add_level, salary_list)
-            wmp_data = c.cal_wmp(wmp_type, wmp_level)
-            tl_data = c.cal_tl(tl_type, tl_level, salary_list)
-            hi_data = c.cal_hi(hi_cost_de)
-            akdd_data = c.cal_akdd(akdd_level)
-
-            # 填入计算结果
-            for pre, data in (
-                ("PCA", pca_data),
-                ("ADD", add_data),
-                ("WMP", wmp_data),
-                ("TL", tl_data),
-                ("HI", hi_data),
-                ("AKDD", akdd_data),
-            ):
-                self.df[f"{pre}_for_com"][r] = data["for_company"]["result"]
-                self.df[f"{pre}_com_formula"][r] = data["for_company"]["formula"]
-                self.df[f"{pre}_for_emy"][r] = data["for_employee"]["result"]
-                self.df[f"{pre}_emy_formula"][r] = data["for_employee"]["formula"]
-
-        self.df.to_excel("new.xlsx")
+        """
+        :param output_path: 输出路径, 格式见 `ResultWriter`
+        :param workers: 进程数, 见 `handle_rows`
+        :param chunk_size: 每块行数, 见 `handle_rows`
+        :param store: 增量计算时保存结果的 `ResultStore`, 为 None 时全部重新计算
+        :param totals: 计算的同时累加保费的 `CostTotals`, 为 None 时不汇总
+        """
+        if totals is not None:
+            self.check_group_cols(totals, list(self.df.columns))
+
+        inserts = self.output_inserts()
+
+        # 按列紧凑保存计算结果, 写入前再展开
+        buffer = ResultBuffer([name for _, name, _ in inserts], self.amount_columns())
+        # 计算前检查整张表, 一次报告全部有问题的行
+        with self.instrument.stage("validate"):
+            dates = self.parse_dates()
+            self.rejected = self.validate(dates)
+        if self.rejected:
+            if not self.skip_invalid:
+                raise self.invalid_rows_error(self.rejected)
+
+            drop = sorted({r["row"] - 1 for r in self.rejected})
+            self.df = self.df.drop(index=drop)
+            dates = tuple(d.drop(index=drop) for d in dates)
+
+        # 无法解析日期的行已在 `validate` 中报错或跳过
+        with self.instrument.stage("dates"):
+            active_days, _ = self.active_days(dates)
+
+        with self.instrument.stage("calculate"):
+            rows = self.input_values()
+            self.rows = len(rows)
+            if store is None:
+                row_results = self.iter_results(rows, active_days, workers, chunk_size)
+            else:
+                row_results = self.handle_rows_incremental(
+                    rows, active_days, store, workers, chunk_size
+                )
+
+            if totals is not None:
+                auto_codes = self.df[self.auto_code].to_numpy(dtype=object)
+                groups = [self.df[c].to_numpy(dtype=object) for c in totals.group_cols]
+
+            for i, res in enumerate(row_results):
+                buffer.append(res)
+                if totals is not None:
+                    totals.add(res, auto_codes[i], tuple(g[i] for g in groups))
+
+        with self.instrument.stage("count"):
+            for auto_code in self.df[self.auto_code]:
+                self.count_plan(self.auto_map.get_plan(auto_code))
+
+        with self.instrument.stage("insert_columns"):
+            self.insert_results(inserts, buffer)
+
+        with self.instrument.stage("write"):
+            self.writer.write(self.df, output_path, self.amount_columns())
+
+        self.instrument.finish()
+
+
+class StreamingExcelHandler(ExcelHandler):
+    """
+    流式处理: 逐行读取、计算、写入, 内存占用与表格行数无关
+    输出的列与 `ExcelHandler.handle_excel` 一致
+    """
+
+    def load(self):
+        return None
+
+    @staticmethod
+    def cell(value):
+        return None if is_null(value) else value
+
+    def stream_rows(
+        self, rows: Iterator[tuple], width: int, positions: List[int]
+    ) -> Iterator[Tuple[int, list, tuple, int]]:
+        """
+        逐行检查, 未通过检查的行计入 `self.rejected`, 整行为空的行同 `load` 跳过
+        :param rows: 表头之后的各行
+        :param width: 表头列数
+        :param positions: `input_fields` 的列位置
+        :return: 通过检查的行 (index, 各列的值, `input_fields` 的值, 实际缴纳天数)
+        """
+        r = self.header_to - 1
+        for values in rows:
+            r += 1
+            if all(v is None for v in values):
+                continue
+
+            # 与 pandas 一致, 空单元格为 NaN
+            values = [float("nan") if v is None else v for v in values]
+            values += [float("nan")] * (width - len(values))
+            inputs = tuple(values[p] for p in positions)
+
+            rejected = self.validate_row(r, inputs)
+            if rejected:
+                # 继续读取, 最后一次报告全部有问题的行
+                self.rejected.extend(rejected)
+            else:
+                _, start, stop = inputs[:3]
+                yield r, values, inputs, (parse_date(stop) - parse_date(start)).days
+
+    def handle_excel(
+        self,
+        output_path: str = "new.xlsx",
+        totals: CostTotals = None,
+        chunk_size: int = 1000,
+    ):
+        """
+        :param output_path: 输出路径, 只支持 xlsx
+        :param totals: 见 `ExcelHandler.handle_excel`
+        :param chunk_size: 每次按列计算的行数, 内存中最多同时保留这些行
+        """
+        if self.writer.format_for(output_path) != "xlsx":
+            raise ValueError("Streaming output only supports xlsx")
+
+        from openpyxl import Workbook, load_workbook
+
+        wb = load_workbook(self.excel_path, read_only=True, data_only=True)
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+
+        header_rows = [next(rows) for _ in range(self.header_to)]
+        headers = self.loader.header_handler(header_rows[self.header_from - 1 :])
+        self.apply_schema(headers)
+        if totals is not None:
+            self.check_group_cols(totals, headers)
+            groups = [headers.index(c) for c in totals.group_cols]
+
+        with self.instrument.stage("salary_changes"):
+            self.salary_changes = self.load_salary_changes()
+
+        cols = self.output_columns(self.output_inserts(), list(headers))
+        positions = [self.positions[f] for f in self.input_fields]
+
+        out = Workbook(write_only=True)
+        ws = out.create_sheet("Sheet1")
+        ws.append([None] + cols)
+
+        self.rejected = []
+        self.rows = 0
+        valid = self.stream_rows(rows, len(headers), positions)
+        with self.instrument.stage("stream"):
+            while True:
+                block = list(islice(valid, chunk_size))
+                if not block:
+                    break
+
+                results = self.handle_batch(
+                    [inputs for _, _, inputs, _ in block],
+                    [active_days for _, _, _, active_days in block],
+                )
+                for (r, values, inputs, _), res in zip(block, results):
+                    auto_code = inputs[4]
+                    if totals is not None:
+                        totals.add(res, auto_code, tuple(values[g] for g in groups))
+
+                    row = dict(zip(headers, values))
+                    row.update(res)
+                    self.count_plan(self.auto_map.get_plan(auto_code))
+                    ws.append([r] + [self.cell(row[c]) for c in cols])
+                    self.rows += 1
+
+        wb.close()
+        if self.rejected and not self.skip_invalid:
+            # 不写出结果, 只释放临时文件
+            ws.close()
+            raise self.invalid_rows_error(self.rejected)
+
+        with self.instrument.stage("write"):
+            out.save(output_path)
+
+        self.instrument.finish()
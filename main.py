@@ -1,6 +1,187 @@
-from handlers import ExcelHandler
+import argparse
+import json
 
+from handlers import (
+    CostTotals,
+    ExcelHandler,
+    Instrument,
+    ResultStore,
+    ResultWriter,
+    Schema,
+    StreamingExcelHandler,
+)
+from runner import find_workbooks, run_batch
 
-if __name__ == '__main__':
-    e = ExcelHandler()
-    e.handle_excel()
+
+def main():
+    parser = argparse.ArgumentParser(description="计算公司与员工缴纳的保费")
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="excel 文件、目录或 glob, 不指定时计算 sample1.xlsx 并输出到 --output",
+    )
+    parser.add_argument("-o", "--output-dir", default="output", help="输出目录")
+    parser.add_argument(
+        "--output", default="new.xlsx", help="不指定 inputs 时的输出路径"
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(set(ResultWriter.formats.values())),
+        default=None,
+        help="输出格式, 默认由输出路径的扩展名决定",
+    )
+    parser.add_argument(
+        "--xlsx-engine",
+        choices=["xlsxwriter", "openpyxl"],
+        default=None,
+        help="xlsx 写入引擎, 默认安装了 xlsxwriter 时使用 xlsxwriter",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="进程数, 处理 inputs 时默认为 CPU 核数, 处理单个文件时默认为 1",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="处理单个文件且 --workers 大于 1 时每个进程每次计算的行数",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="处理单个文件时逐行读取、计算、写入 xlsx, 内存占用与行数无关, "
+        "不支持 --store 与 --workers",
+    )
+    parser.add_argument(
+        "--rates",
+        default="rates.json",
+        help="费率表文件 (JSON), 格式见 rates.example.json",
+    )
+    parser.add_argument(
+        "--no-formula", action="store_true", help="不输出计算公式, `*_formula` 列为空"
+    )
+    parser.add_argument(
+        "--salary-sheet",
+        default=None,
+        help="工资变动记录所在的 sheet, 有记录的员工按变动拆分工资",
+    )
+    parser.add_argument(
+        "--schema",
+        default=None,
+        help="表格格式文件 (JSON), 指定表头所在的行与各字段对应的列, 见 handlers.Schema",
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="增量计算: 保存每行结果的数据库, 只重新计算变化的行",
+    )
+    parser.add_argument(
+        "--skip-invalid",
+        action="store_true",
+        help="跳过未通过检查的行 (日期、工资、保费、计划), 默认有这样的行时不计算并报错",
+    )
+    parser.add_argument(
+        "--totals",
+        default=None,
+        help="计算的同时汇总保费并输出到该路径 (.json 或表格格式), "
+        "指定 inputs 时每个文件输出 {文件名}_totals.json 到输出目录",
+    )
+    parser.add_argument(
+        "--group-by",
+        action="append",
+        default=[],
+        help="汇总保费时另外分组的列, 如部门, 可以重复指定",
+    )
+    parser.add_argument("--report", default=None, help="运行统计 JSON 的输出路径")
+    parser.add_argument(
+        "--profile", action="store_true", help="运行统计中包含 cProfile 结果"
+    )
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="运行统计中包含内存峰值"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="逐行打印姓名")
+    args = parser.parse_args()
+    writer = ResultWriter(args.format, args.xlsx_engine)
+    if args.group_by and not args.totals:
+        parser.error("--group-by requires --totals")
+    if args.stream and (args.inputs or args.store or (args.workers or 1) > 1):
+        parser.error(
+            "--stream only supports a single file without --store or --workers"
+        )
+
+    schema = Schema.from_file(args.schema) if args.schema else None
+
+    if not args.inputs:
+        instrument = Instrument(profile=args.profile, trace_memory=args.trace_memory)
+        handler_class = StreamingExcelHandler if args.stream else ExcelHandler
+        e = handler_class(
+            instrument=instrument,
+            verbose=args.verbose,
+            writer=writer,
+            rate_card=args.rates,
+            with_formula=not args.no_formula,
+            salary_sheet=args.salary_sheet,
+            skip_invalid=args.skip_invalid,
+            schema=schema,
+        )
+        store = ResultStore(args.store) if args.store else None
+        totals = CostTotals(args.group_by) if args.totals else None
+        if args.stream:
+            e.handle_excel(args.output, totals=totals)
+        else:
+            e.handle_excel(
+                args.output,
+                workers=args.workers or 1,
+                chunk_size=args.chunk_size,
+                store=store,
+                totals=totals,
+            )
+        if totals is not None:
+            totals.write(args.totals)
+        if store is not None:
+            store.close()
+            print(e.incremental_stats)
+        if e.rejected:
+            rows = len({r["row"] for r in e.rejected})
+            print(f"{rows} invalid rows skipped, see --report")
+
+        if args.report is not None:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(e.report(), f, ensure_ascii=False, indent=2)
+        return
+
+    paths = []
+    for target in args.inputs:
+        paths.extend(find_workbooks(target))
+
+    summary = run_batch(
+        paths,
+        args.output_dir,
+        args.workers,
+        store_path=args.store,
+        writer=writer,
+        rate_card=args.rates,
+        with_formula=not args.no_formula,
+        salary_sheet=args.salary_sheet,
+        skip_invalid=args.skip_invalid,
+        schema=schema,
+        group_by=args.group_by if args.totals else None,
+    )
+    for f in summary["files"]:
+        status = f["error"] or "ok"
+        print(
+            f"{f['input']}: {f['rows']} rows, {f['rejected']} rejected, "
+            f"{f['seconds']}s, {status}"
+        )
+
+    print(
+        f"{len(summary['files'])} files, {summary['rows']} rows, "
+        f"{summary['seconds']}s, {summary['failed']} failed"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+计算一名员工的保费, 不读取表格, 不导入 pandas / openpyxl
+产品名称与 auto.xlsx 中的写法相同
+
+python quote.py --salary 12000 --start 2021/02/01 --stop 2021/12/31 \
+    --add 员工意外VIP --wmp 员工医疗加强 --tl 员工定寿基础 --hi 员工住院津贴加强
+"""
+
+import argparse
+import json
+
+from calculator import CostCalculator
+from handlers import (
+    AutoMapHandler,
+    AutoNameHandler,
+    ExcelHandler,
+    cost_plan,
+    time_serialize,
+)
+
+PRODUCTS = ("PCA", "ADD", "WMP", "TL", "HI", "AKDD")
+
+
+def quote(
+    calculator: CostCalculator,
+    names: dict,
+    salary,
+    active_days: int,
+    pca_cost=0,
+    hi_cost=0,
+) -> dict:
+    """
+    :param names: {"pca": 名称, "add": ..., "wmp": ..., "tl": ..., "hi": ..., "akdd": ...}
+    :return: 同 `cost_plan`
+    """
+    names = {"name": None, **{p.lower(): None for p in PRODUCTS}, **names}
+    plan = AutoMapHandler.build_plan(names, AutoNameHandler(), calculator)
+    return cost_plan(
+        calculator,
+        plan,
+        ExcelHandler.to_decimal(salary),
+        active_days,
+        ExcelHandler.to_decimal(pca_cost),
+        ExcelHandler.to_decimal(hi_cost),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="计算一名员工的保费")
+    parser.add_argument("--salary", default="0", help="工资")
+    parser.add_argument("--days", type=int, default=None, help="实际缴纳天数")
+    parser.add_argument("--start", default=None, help="生效日期, 如 2021/01/01")
+    parser.add_argument("--stop", default=None, help="终止日期, 如 2021/12/31")
+    for product in PRODUCTS:
+        parser.add_argument(
+            f"--{product.lower()}", default=None, help=f"{product} 名称"
+        )
+    parser.add_argument("--pca-cost", default="0", help="PCA 保费")
+    parser.add_argument("--hi-cost", default="0", help="HI 保费")
+    parser.add_argument(
+        "--rates",
+        default="rates.json",
+        help="费率表文件 (JSON), 格式见 rates.example.json",
+    )
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出")
+    args = parser.parse_args()
+
+    if args.days is not None:
+        active_days = args.days
+    elif args.start is not None and args.stop is not None:
+        active_days = (time_serialize(args.stop) - time_serialize(args.start)).days
+    else:
+        parser.error("either --days or both --start and --stop are required")
+
+    calculator = CostCalculator.from_file(
+        args.rates, days_of_year=ExcelHandler.days_of_year
+    )
+    names = {p.lower(): getattr(args, p.lower()) for p in PRODUCTS}
+    res = quote(
+        calculator, names, args.salary, active_days, args.pca_cost, args.hi_cost
+    )
+
+    if args.json:
+        print(json.dumps(res, ensure_ascii=False, default=str, indent=2))
+        return
+
+    print(f"active days: {active_days}")
+    for pre in PRODUCTS:
+        print(
+            f"{pre}: {res[f'{pre}_type']}\n"
+            f"  company:  {res[f'{pre}_for_com']} = {res[f'{pre}_com_formula']}\n"
+            f"  employee: {res[f'{pre}_for_emy']} = {res[f'{pre}_emy_formula']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional
+
+from calculator import CostCalculator
+from handlers import (
+    AutoMapHandler,
+    CostTotals,
+    ExcelHandler,
+    ResultStore,
+    ResultWriter,
+    Schema,
+)
+
+# 子进程共享的计划表与计算器, 由 `init_worker` 在子进程启动时设置一次
+_auto_map = None
+_calculator = None
+
+
+def init_worker(auto_map: AutoMapHandler, calculator: CostCalculator = None):
+    global _auto_map, _calculator
+    _auto_map = auto_map
+    _calculator = calculator
+
+
+def find_workbooks(target: str) -> List[str]:
+    """
+    :param target: 目录或 glob, 目录时取其中所有 xlsx
+    :return:
+    """
+    if os.path.isdir(target):
+        target = os.path.join(target, "*.xlsx")
+
+    # 跳过 excel 打开文件时生成的 `~$` 临时文件
+    return sorted(
+        path
+        for path in glob.glob(target)
+        if not os.path.basename(path).startswith("~$")
+    )
+
+
+def common_root(paths: List[str]) -> Optional[str]:
+    """
+    :return: 所有文件所在目录的共同上级目录, 没有文件时为 None
+    """
+    if not paths:
+        return None
+
+    return os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+
+def output_path_for(
+    path: str,
+    output_dir: str,
+    extension: str = ".xlsx",
+    suffix: str = "_new",
+    root: str = None,
+) -> str:
+    """
+    :param root: 输入文件的共同上级目录, 见 `common_root`, 不为 None 时在输出目录中保留相对于它的子目录,
+    不同目录中的同名文件不会互相覆盖
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if root is not None:
+        sub = os.path.relpath(os.path.dirname(os.path.abspath(path)), root)
+        if sub != os.curdir:
+            output_dir = os.path.join(output_dir, sub)
+
+    return os.path.join(output_dir, f"{stem}{suffix}{extension}")
+
+
+def process_file(
+    path: str,
+    output_dir: str,
+    store_path: str = None,
+    writer: ResultWriter = None,
+    salary_sheet: Optional[str] = None,
+    skip_invalid: bool = False,
+    schema: Schema = None,
+    group_by: Optional[Iterable[str]] = None,
+    root: str = None,
+) -> dict:
+    """
+    在子进程中计算一个表格
+    :param store_path: 增量计算结果的数据库路径, 为 None 时全部重新计算
+    :param writer: 结果输出方式, 为 None 时输出 xlsx
+    :param salary_sheet: 工资变动记录所在的 sheet, 见 `ExcelHandler`
+    :param skip_invalid: 是否跳过未通过检查的行, 见 `ExcelHandler`
+    :param schema: 表格格式, 见 `ExcelHandler`
+    :param group_by: 不为 None 时计算的同时汇总保费, 按产品、auto_code 与这些列分组,
+    输出为 `{文件名}_totals.json`, 见 `CostTotals`
+    :param root: 输出时保留相对于该目录的子目录, 见 `output_path_for`
+    :return: 该文件的处理结果
+    """
+    writer = writer or ResultWriter()
+    start = time.perf_counter()
+    summary = {
+        "input": path,
+        "output": output_path_for(path, output_dir, writer.extension(), root=root),
+        "rows": 0,
+        "rejected": 0,
+        "totals": None,
+        "seconds": 0,
+        "error": None,
+    }
+
+    store = None
+    try:
+        os.makedirs(os.path.dirname(summary["output"]) or os.curdir, exist_ok=True)
+        e = ExcelHandler(
+            excel_path=path,
+            auto_map=_auto_map,
+            writer=writer,
+            calculator=_calculator,
+            salary_sheet=salary_sheet,
+            skip_invalid=skip_invalid,
+            schema=schema,
+        )
+        if store_path is not None:
+            store = ResultStore(store_path)
+
+        totals = None if group_by is None else CostTotals(group_by)
+        e.handle_excel(summary["output"], store=store, totals=totals)
+        if totals is not None:
+            summary["totals"] = output_path_for(
+                path, output_dir, ".json", "_totals", root
+            )
+            totals.write(summary["totals"])
+
+        summary["rows"] = e.rows
+        summary["rejected"] = len({r["row"] for r in e.rejected})
+        if e.incremental_stats is not None:
+            summary.update(e.incremental_stats)
+
+        summary["report"] = e.report()
+    except Exception as exc:
+        # 单个文件出错不影响其他文件, 错误记录在汇总中
+        summary["error"] = f"{type(exc).__name__}: {exc}"
+    finally:
+        if store is not None:
+            store.close()
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def run_batch(
+    paths: List[str],
+    output_dir: str,
+    workers: Optional[int] = None,
+    auto_path: str = "auto.xlsx",
+    store_path: str = None,
+    writer: ResultWriter = None,
+    rate_card: str = "rates.json",
+    with_formula: bool = True,
+    salary_sheet: Optional[str] = None,
+    skip_invalid: bool = False,
+    schema: Schema = None,
+    group_by: Optional[Iterable[str]] = None,
+) -> dict:
+    """
+    多进程计算多个表格
+    :param paths: 表格路径
+    :param output_dir: 输出目录, 每个文件输出为 `{文件名}_new.{格式}`, 汇总输出为 `summary.json`
+    输入文件来自多个目录时保留相对于共同上级目录的子目录, 见 `output_path_for`
+    :param workers: 进程数, 默认为 CPU 核数
+    :param auto_path: auto 表路径, 只在主进程读取一次
+    :param store_path: 增量计算结果的数据库路径, 见 `process_file`
+    :param writer: 结果输出方式, 见 `process_file`
+    :param rate_card: 费率表文件, 只在主进程读取一次
+    :param with_formula: 是否输出计算公式, 见 `ExcelHandler`
+    :param salary_sheet: 工资变动记录所在的 sheet, 见 `process_file`
+    :param skip_invalid: 是否跳过未通过检查的行, 见 `process_file`
+    :param schema: 表格格式, 见 `process_file`
+    :param group_by: 汇总保费的分组列, 见 `process_file`
+    :return: 汇总
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    root = common_root(paths)
+    auto_map = AutoMapHandler(path=auto_path)
+    calculator = CostCalculator.from_file(
+        rate_card, days_of_year=ExcelHandler.days_of_year, with_formula=with_formula
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(auto_map, calculator)
+    ) as pool:
+        files = list(
+            pool.map(
+                process_file,
+                paths,
+                [output_dir] * len(paths),
+                [store_path] * len(paths),
+                [writer] * len(paths),
+                [salary_sheet] * len(paths),
+                [skip_invalid] * len(paths),
+                [schema] * len(paths),
+                [group_by] * len(paths),
+                [root] * len(paths),
+            )
+        )
+
+    summary = {
+        "workers": workers or os.cpu_count(),
+        "seconds": round(time.perf_counter() - start, 3),
+        "rows": sum(f["rows"] for f in files),
+        "rejected": sum(f["rejected"] for f in files),
+        "failed": sum(1 for f in files if f["error"] is not None),
+        "files": files,
+    }
+
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    return summary
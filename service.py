@@ -0,0 +1,294 @@
+"""
+常驻服务: 通过 HTTP 上传表格, 返回计算后的表格
+计划表与费率表只在启动时读取一次, 计算在进程池中进行
+
+应用为 ASGI 应用, 可以由任意 ASGI 服务器运行, `main` 使用 uvicorn
+python service.py --port 8000
+
+POST /cost?format=xlsx  请求体为表格文件本身, 返回计算后的文件
+GET /health             返回运行中与排队中的请求数
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qs
+
+from calculator import CostCalculator
+from handlers import AutoMapHandler, ExcelHandler, ResultWriter
+from runner import init_worker, process_file
+
+CONTENT_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class CostService:
+    """
+    ASGI 应用
+    workers: 计算进程数, 默认为 CPU 核数
+    concurrency: 同时计算的请求数, 其余请求排队
+    max_queue: 排队请求数上限, 超出时返回 503
+    max_body: 上传文件大小上限 (字节), 超出时返回 413
+    auto_path: auto 表路径
+    rate_card: 费率表文件
+    with_formula: 是否输出计算公式
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        concurrency: int = None,
+        max_queue: int = 100,
+        max_body: int = 50 * 1024 * 1024,
+        auto_path: str = "auto.xlsx",
+        rate_card: str = "rates.json",
+        with_formula: bool = True,
+    ):
+        self.workers = workers or os.cpu_count()
+        self.concurrency = concurrency or self.workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.auto_path = auto_path
+        self.rate_card = rate_card
+        self.with_formula = with_formula
+
+        self.pool = None
+        self.semaphore = None
+        self.running = 0
+        self.queued = 0
+
+    def startup(self):
+        """
+        读取计划表与费率表并启动进程池, 子进程启动时各接收一份
+        """
+        auto_map = AutoMapHandler(path=self.auto_path)
+        calculator = CostCalculator.from_file(
+            self.rate_card,
+            days_of_year=ExcelHandler.days_of_year,
+            with_formula=self.with_formula,
+        )
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(auto_map, calculator),
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    self.startup()
+                except Exception as exc:
+                    await send({"type": "lifespan.startup.failed", "message": str(exc)})
+                    return
+
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        method = scope["method"]
+        path = scope["path"]
+        if path == "/health" and method == "GET":
+            await self.send_json(
+                send, 200, {"running": self.running, "queued": self.queued}
+            )
+        elif path == "/cost" and method == "POST":
+            await self.cost(scope, receive, send)
+        elif path in ("/health", "/cost"):
+            await self.send_json(send, 405, {"error": "Method not allowed"})
+        else:
+            await self.send_json(send, 404, {"error": "Not found"})
+
+    async def cost(self, scope, receive, send):
+        query = parse_qs(scope.get("query_string", b"").decode())
+        fmt = query.get("format", ["xlsx"])[0]
+        if fmt not in CONTENT_TYPES:
+            await self.send_json(send, 400, {"error": f"Unknown format: {fmt}"})
+            return
+
+        # 读取请求体前先排队, 避免同时缓存大量上传文件
+        # 只有需要等待时才算排队, 空闲时 max_queue 为 0 也可以直接处理
+        if self.semaphore.locked():
+            if self.queued >= self.max_queue:
+                await self.send_json(send, 503, {"error": "Too many queued requests"})
+                return
+
+            self.queued += 1
+            try:
+                await self.semaphore.acquire()
+            finally:
+                self.queued -= 1
+        else:
+            await self.semaphore.acquire()
+
+        self.running += 1
+        workdir = tempfile.mkdtemp()
+        try:
+            try:
+                body = await self.read_body(receive)
+            except ConnectionError:
+                # 客户端已断开, 不再返回响应
+                return
+
+            if body is None:
+                await self.send_json(send, 413, {"error": "Request body too large"})
+                return
+
+            input_path = os.path.join(workdir, "roster.xlsx")
+            with open(input_path, "wb") as f:
+                f.write(body)
+
+            loop = asyncio.get_running_loop()
+            summary = await loop.run_in_executor(
+                self.pool,
+                process_file,
+                input_path,
+                workdir,
+                None,
+                ResultWriter(fmt),
+            )
+            if summary["error"] is not None:
+                await self.send_json(send, 422, {"error": summary["error"]})
+                return
+
+            await self.send_file(send, summary, CONTENT_TYPES[fmt])
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    async def read_body(self, receive) -> Optional[bytes]:
+        """
+        :return: 请求体, 超出 `max_body` 时为 None
+        :raise ConnectionError: 上传完成前客户端断开
+        """
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("Client disconnected")
+
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body:
+                return None
+
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def send_file(self, send, summary: dict, content_type: str):
+        """
+        分块返回计算结果, 不一次读入整个文件
+        """
+        path = summary["output"]
+        filename = os.path.basename(path)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", content_type.encode()),
+                    (b"content-length", str(os.path.getsize(path)).encode()),
+                    (
+                        b"content-disposition",
+                        f'attachment; filename="{filename}"'.encode(),
+                    ),
+                    (b"x-rows", str(summary["rows"]).encode()),
+                    (b"x-seconds", str(summary["seconds"]).encode()),
+                ],
+            }
+        )
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                more = len(chunk) == self.chunk_size
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": more}
+                )
+                if not more:
+                    break
+
+    @staticmethod
+    async def send_json(send, status: int, data: dict):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保费计算服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None, help="计算进程数, 默认为 CPU 核数"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=None, help="同时计算的请求数, 默认为进程数"
+    )
+    parser.add_argument("--max-queue", type=int, default=100, help="排队请求数上限")
+    parser.add_argument("--auto", default="auto.xlsx", help="auto 表路径")
+    parser.add_argument(
+        "--rates",
+        default="rates.json",
+        help="费率表文件 (JSON), 格式见 rates.example.json",
+    )
+    parser.add_argument(
+        "--no-formula", action="store_true", help="不输出计算公式, `*_formula` 列为空"
+    )
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("uvicorn is required to run the service: pip install uvicorn")
+
+    app = CostService(
+        workers=args.workers,
+        concurrency=args.concurrency,
+        max_queue=args.max_queue,
+        auto_path=args.auto,
+        rate_card=args.rates,
+        with_formula=not args.no_formula,
+    )
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
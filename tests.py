@@ -0,0 +1,988 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from decimal import MAX_PREC, ROUND_FLOOR, Context, Decimal, localcontext
+
+from calculator import BatchCostCalculator, CostCalculator, FixedPoint
+from handlers import (
+    AutoMapHandler,
+    CostTotals,
+    ExcelHandler,
+    Instrument,
+    ResultBuffer,
+    ResultStore,
+    ResultWriter,
+    SalaryChanges,
+    Schema,
+    StreamingExcelHandler,
+    WorkbookLoader,
+)
+from runner import common_root, output_path_for
+from service import CostService
+
+RATES = {
+    "pca_amount": Decimal(500000),
+    "pca_epy_rate": Decimal("0.00005"),
+    "add_mag": {1: Decimal(24), 2: Decimal(36), 3: Decimal(48)},
+    "add_basic_mag": Decimal(24),
+    "add_rate": Decimal("0.00013"),
+    "wmp_emy_cost": {1: Decimal(1200), 3: Decimal("2500.5"), 4: Decimal(3100)},
+    "wmp_emy_basic_cost": Decimal(1200),
+    "wmp_sps_cost": {1: Decimal(1500), 3: Decimal(2900)},
+    "wmp_chd_cost": {1: Decimal(800), 2: Decimal(1200), 3: Decimal(2500)},
+    "wmp_chd_basic_cost": Decimal(800),
+    "tl_mag": {1: Decimal(12), 2: Decimal(24), 3: Decimal(36)},
+    "tl_basic_mag": Decimal(12),
+    "tl_rate": Decimal("0.00031"),
+    "hi_basic_amount": Decimal(100),
+    "hi_rate": Decimal("0.7"),
+    "akdd_amount": {1: Decimal(100000), 2: Decimal(200000), 3: Decimal(500000)},
+    "akdd_basic_amount": Decimal(100000),
+    "akdd_rate": Decimal("0.0009"),
+}
+
+DAYS_OF_YEAR = 365 - 31
+
+# 每个性质检查的随机样本数
+EXAMPLES = 5000
+
+
+def random_number(rng: random.Random):
+    """
+    随机生成 int / float / Decimal, 包括负数、极长的系数与恰好为半分的值
+    """
+    kind = rng.randrange(6)
+    if kind == 0:
+        return rng.randint(-(10**6), 10**6)
+    if kind == 1:
+        return rng.uniform(-1e6, 1e6)
+    if kind == 2:
+        return Decimal(rng.randint(-(10**40), 10**40)).scaleb(-rng.randint(0, 45))
+    if kind == 3:
+        # 半分: x.xx5
+        return Decimal(rng.randint(-(10**6), 10**6) * 10 + 5).scaleb(-3)
+    if kind == 4:
+        return Decimal(rng.randint(0, 10**28 - 1)).scaleb(rng.randint(-30, 5))
+    return Decimal(rng.choice(["0", "-0", "0.005", "-0.005", "9" * 28, "1E-30"]))
+
+
+def has_module(name: str) -> bool:
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+
+    return True
+
+
+class RosterTestCase(unittest.TestCase):
+    """
+    在临时目录中生成计划表与表格 (见 `bench.py`), 需要 pandas 与 openpyxl
+    """
+
+    rows = 40
+
+    @classmethod
+    def setUpClass(cls):
+        import bench
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        codes = bench.generate_auto(cls.path("auto.xlsx"))
+        cls.roster = cls.path("roster.xlsx")
+        bench.generate_roster(cls.roster, cls.rows, codes)
+        cls.auto_map = AutoMapHandler(path=cls.path("auto.xlsx"))
+        cls.calculator = CostCalculator(
+            bench.SYNTHETIC_RATES, ExcelHandler.days_of_year
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    @classmethod
+    def path(cls, name: str) -> str:
+        return os.path.join(cls.tmp.name, name)
+
+    def edit_roster(self, name: str, cells: dict) -> str:
+        """
+        :param cells: {(excel 行号, 列号): 值}, 数据从第 3 行开始
+        :return: 修改后的表格路径
+        """
+        import openpyxl
+
+        wb = openpyxl.load_workbook(self.roster)
+        ws = wb.worksheets[0]
+        for (r, c), value in cells.items():
+            ws.cell(r, c).value = value
+
+        path = self.path(name)
+        wb.save(path)
+        return path
+
+    def handler(self, path: str = None, **kwargs) -> ExcelHandler:
+        return ExcelHandler(
+            path or self.roster,
+            auto_map=self.auto_map,
+            calculator=self.calculator,
+            **kwargs,
+        )
+
+
+class FixedPointTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(2021)
+        self.fixed = FixedPoint()
+
+    def value(self, num) -> Decimal:
+        n, exp = num
+        return Decimal(n).scaleb(exp, Context(prec=MAX_PREC))
+
+    def test_convert_is_exact(self):
+        for _ in range(EXAMPLES):
+            num = random_number(self.rng)
+            self.assertEqual(self.value(self.fixed.convert(num)), Decimal(num))
+
+    def test_mul_matches_decimal(self):
+        for _ in range(EXAMPLES):
+            a, b = random_number(self.rng), random_number(self.rng)
+            res = self.fixed.mul(self.fixed.convert(a), self.fixed.convert(b))
+            self.assertEqual(self.value(res), Decimal(a) * Decimal(b), (a, b))
+
+    def test_add_matches_decimal(self):
+        for _ in range(EXAMPLES):
+            a, b = random_number(self.rng), random_number(self.rng)
+            res = self.fixed.add(self.fixed.convert(a), self.fixed.convert(b))
+            self.assertEqual(self.value(res), Decimal(a) + Decimal(b), (a, b))
+
+    def test_to_fen_matches_handle_result(self):
+        for _ in range(EXAMPLES):
+            num = Decimal(random_number(self.rng))
+            if abs(num) >= 10**20:
+                # 超出 `quantize` 的精度范围
+                continue
+
+            fen = self.fixed.to_fen(self.fixed.convert(num))
+            expected = CostCalculator.handle_result(num)
+            self.assertEqual(Decimal(fen).scaleb(-2), Decimal(expected), num)
+
+    def test_ignores_decimal_context(self):
+        a, b = Decimal("2.675"), Decimal("1.0000000000000000000000000001")
+        expected = self.fixed.mul(self.fixed.convert(a), self.fixed.convert(b))
+        with localcontext() as ctx:
+            ctx.prec = 5
+            ctx.rounding = ROUND_FLOOR
+            res = self.fixed.mul(self.fixed.convert(a), self.fixed.convert(b))
+
+        self.assertEqual(res, expected)
+
+    def test_rejects_non_finite(self):
+        for num in (float("nan"), float("inf"), Decimal("NaN"), Decimal("-Infinity")):
+            with self.assertRaises(ValueError):
+                self.fixed.convert(num)
+
+
+class BatchCostCalculatorTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(334)
+        self.calculator = CostCalculator(RATES, DAYS_OF_YEAR)
+        self.batch = BatchCostCalculator(RATES, DAYS_OF_YEAR)
+        n = EXAMPLES
+        self.types = [self.rng.choice(["epy", "sps", "chd", None]) for _ in range(n)]
+        self.levels = [self.rng.choice([1, 2, 3, 4, None]) for _ in range(n)]
+        self.salaries = [self.salary() for _ in range(n)]
+        self.days = [
+            self.rng.choice([DAYS_OF_YEAR, 1, 0, -5, self.rng.randint(1, 366)])
+            for _ in range(n)
+        ]
+        self.costs = [Decimal(self.rng.uniform(0, 1000)) for _ in range(n)]
+
+    def salary(self):
+        kind = self.rng.randrange(3)
+        if kind == 0:
+            return Decimal(self.rng.randrange(3000, 60000, 100))
+        if kind == 1:
+            # 与 `ExcelHandler.to_decimal` 一致, float 单元格转换为 Decimal
+            return Decimal(self.rng.uniform(1000, 90000))
+        return Decimal(self.rng.randint(1, 10**7)).scaleb(-2)
+
+    @staticmethod
+    def fen(data):
+        return (
+            BatchCostCalculator.to_fen(data.for_company.result),
+            BatchCostCalculator.to_fen(data.for_employee.result),
+        )
+
+    def assertBatchEqual(self, batch, expected):
+        company, employee = batch
+        self.assertEqual(list(zip(company, employee)), expected)
+
+    def test_add(self):
+        c = self.calculator
+        expected = [
+            self.fen(c.cal_add(t, lv, [(s, Decimal(d))]))
+            for t, lv, s, d in zip(self.types, self.levels, self.salaries, self.days)
+        ]
+        self.assertBatchEqual(
+            self.batch.cal_add_batch(self.types, self.levels, self.salaries, self.days),
+            expected,
+        )
+
+    def test_tl(self):
+        c = self.calculator
+        expected = [
+            self.fen(c.cal_tl(t, lv, [(s, Decimal(d))]))
+            for t, lv, s, d in zip(self.types, self.levels, self.salaries, self.days)
+        ]
+        self.assertBatchEqual(
+            self.batch.cal_tl_batch(self.types, self.levels, self.salaries, self.days),
+            expected,
+        )
+
+    def test_wmp(self):
+        c = self.calculator
+        expected = [
+            self.fen(c.cal_wmp(t, lv, d))
+            for t, lv, d in zip(self.types, self.levels, self.days)
+        ]
+        self.assertBatchEqual(
+            self.batch.cal_wmp_batch(self.types, self.levels, self.days), expected
+        )
+
+    def test_akdd(self):
+        c = self.calculator
+        expected = [
+            self.fen(c.cal_akdd(lv, d)) for lv, d in zip(self.levels, self.days)
+        ]
+        self.assertBatchEqual(
+            self.batch.cal_akdd_batch(self.levels, self.days), expected
+        )
+
+    def test_salary_segments(self):
+        c = self.calculator
+        salary_lists = [
+            (
+                [
+                    (self.salary(), Decimal(self.rng.randint(0, 120)))
+                    for _ in range(self.rng.randint(1, 4))
+                ]
+                if self.rng.random() < 0.5
+                else None
+            )
+            for _ in self.types
+        ]
+        for method in ("cal_add", "cal_tl"):
+            expected = [
+                self.fen(getattr(c, method)(t, lv, salary_list or [(s, Decimal(d))]))
+                for t, lv, s, d, salary_list in zip(
+                    self.types, self.levels, self.salaries, self.days, salary_lists
+                )
+            ]
+            self.assertBatchEqual(
+                getattr(self.batch, f"{method}_batch")(
+                    self.types, self.levels, self.salaries, self.days, salary_lists
+                ),
+                expected,
+            )
+
+    def test_pca_and_hi(self):
+        c = self.calculator
+        for re_cal in (False, True):
+            self.assertBatchEqual(
+                self.batch.cal_pca_batch(self.costs, self.days, re_cal),
+                [
+                    self.fen(c.cal_pca(cost, d, re_cal))
+                    for cost, d in zip(self.costs, self.days)
+                ],
+            )
+            self.assertBatchEqual(
+                self.batch.cal_hi_batch(self.costs, self.days, re_cal),
+                [
+                    self.fen(c.cal_hi(cost, d, re_cal))
+                    for cost, d in zip(self.costs, self.days)
+                ],
+            )
+
+    def test_results(self):
+        # 与逐行计算的结果形式相同: 不缴纳为 0, 恰好为 0 为 "0", 否则为取整后的 Decimal
+        c = self.calculator
+        plans = [
+            {
+                "add": (t, lv),
+                "wmp": (t, lv),
+                "tl": (t, lv),
+                "akdd": (None, lv),
+            }
+            for t, lv in zip(self.types, self.levels)
+        ]
+        results = self.batch.cal_plan_results(plans, self.salaries, self.days)
+        for pre, cal, args in (
+            ("ADD", c.cal_add, lambda t, lv, s, d: (t, lv, [(s, Decimal(d))])),
+            ("WMP", c.cal_wmp, lambda t, lv, s, d: (t, lv, d)),
+            ("TL", c.cal_tl, lambda t, lv, s, d: (t, lv, [(s, Decimal(d))])),
+            ("AKDD", c.cal_akdd, lambda t, lv, s, d: (lv, d)),
+        ):
+            company, employee = results[pre]
+            for k, row in enumerate(
+                zip(self.types, self.levels, self.salaries, self.days)
+            ):
+                data = cal(*args(*row))
+                for value, share in (
+                    (company[k], data.for_company),
+                    (employee[k], data.for_employee),
+                ):
+                    self.assertEqual(repr(value), repr(share.result), (pre, row))
+
+
+@unittest.skipUnless(has_module("pandas"), "bench requires pandas")
+class RateCardTest(unittest.TestCase):
+    def test_example(self):
+        import bench
+
+        path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "rates.example.json"
+        )
+        rates = CostCalculator.read_rates(path)
+        self.assertEqual(rates, bench.SYNTHETIC_RATES)
+        CostCalculator(rates)
+
+
+class SalaryChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(12)
+        self.start = datetime(2021, 2, 1)
+        self.stop = datetime(2021, 12, 31)
+
+    def random_changes(self, keys):
+        records = []
+        for key in keys:
+            for _ in range(self.rng.randint(0, 6)):
+                date = datetime(2021, 1, 1) + timedelta(days=self.rng.randint(0, 400))
+                records.append((key, date, Decimal(self.rng.randrange(3000, 60000))))
+
+        self.rng.shuffle(records)
+        return records
+
+    def test_segments_cover_period(self):
+        keys = [f"员工{i}" for i in range(200)]
+        records = self.random_changes(keys)
+        changes = SalaryChanges(records)
+        for key in keys:
+            segments = changes.segments(key, self.start, self.stop, Decimal(1))
+            self.assertEqual(sum(d for _, d in segments), (self.stop - self.start).days)
+
+            # 每天的工资为该日及之前最后一条变动, 没有变动时为花名册中的工资
+            # 同一天的多条变动以后出现的为准
+            own = sorted(
+                ((d, s) for k, d, s in records if k == key), key=lambda r: r[0]
+            )
+            day = self.start
+            for salary, days in segments:
+                for _ in range(int(days)):
+                    before = [s for d, s in own if d <= day]
+                    self.assertEqual(salary, before[-1] if before else Decimal(1))
+                    day += timedelta(days=1)
+
+    def test_without_changes(self):
+        changes = SalaryChanges([])
+        self.assertNotIn("员工", changes)
+        self.assertEqual(
+            changes.segments("员工", self.start, self.stop, Decimal(5000)),
+            [(Decimal(5000), Decimal(333))],
+        )
+
+
+class SchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.headers = WorkbookLoader.header_handler(
+            [
+                ["", None, "PCA", None, "ADD", None],
+                ["客户", None, "_B", None, "_B", None],
+                ["姓名", "工资", "保额", "保费", "保额", "保费"],
+            ]
+        )
+
+    def test_header_rows(self):
+        self.assertEqual(
+            self.headers,
+            ["客户姓名", "工资", "PCA_B保额", "保费", "ADD_B保额", "保费.1"],
+        )
+
+    def test_resolve(self):
+        # 表中没有的字段都指向工资列
+        fields = {f: "工资" for f in Schema.default}
+        fields.update(
+            {
+                "name": "客户姓名",
+                "pca_cost": "保费",
+                "add_cost": "保费.1",
+                "wmp_amount": {"pattern": "保额$", "occurrence": 1},
+                "wmp_cost": {"pattern": "^保费"},
+            }
+        )
+        positions = Schema(fields).resolve(self.headers)
+        self.assertEqual(positions["name"], 0)
+        self.assertEqual(positions["start"], 1)
+        self.assertEqual(positions["add_cost"], 5)
+        self.assertEqual(positions["wmp_amount"], 4)
+        self.assertEqual(positions["wmp_cost"], 3)
+
+    def test_missing_columns(self):
+        with self.assertRaises(ValueError) as ctx:
+            Schema().resolve(self.headers)
+        self.assertIn("start", str(ctx.exception))
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            Schema({"begin": "生效日期"})
+
+
+class CostTotalsTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(24)
+
+    def result(self) -> dict:
+        res = {}
+        for pre in CostTotals.products:
+            for c in ("for_com", "for_emy"):
+                cents = self.rng.randint(0, 10**7)
+                res[f"{pre}_{c}"] = "0" if not cents else Decimal(cents).scaleb(-2)
+
+        return res
+
+    def test_rollups_match_row_sums(self):
+        rows = [
+            (self.result(), self.rng.choice(["S1", "S2", None]), self.rng.randrange(5))
+            for _ in range(EXAMPLES)
+        ]
+        totals = CostTotals(["部门"])
+        for res, auto_code, group in rows:
+            totals.add(res, auto_code, (group,))
+
+        data = totals.to_dict()
+        self.assertEqual(data["total"][""]["rows"], len(rows))
+        for group, index in (("auto_code", 1), ("部门", 2)):
+            for value in {row[index] for row in rows}:
+                own = [row[0] for row in rows if row[index] == value]
+                key = "" if value is None else str(value)
+                self.assertEqual(data[group][key]["rows"], len(own))
+                for pre in CostTotals.products:
+                    for c in ("for_com", "for_emy"):
+                        expected = sum(Decimal(res[f"{pre}_{c}"]) for res in own)
+                        self.assertEqual(
+                            Decimal(data[group][key]["products"][pre][c]), expected
+                        )
+
+    def test_null_groups_are_merged(self):
+        totals = CostTotals(["部门"])
+        for _ in range(3):
+            totals.add(self.result(), "S1", (float("nan"),))
+
+        self.assertEqual(totals.to_dict()["部门"][""]["rows"], 3)
+
+    def test_empty_costs_are_skipped(self):
+        totals = CostTotals()
+        expected = Decimal(0)
+        for _ in range(3):
+            res = self.result()
+            expected += Decimal(res["PCA_for_emy"])
+            totals.add(res, "S1")
+
+        # 保费单元格为空的行
+        res = self.result()
+        res["PCA_for_emy"] = Decimal("NaN")
+        totals.add(res, "S1")
+
+        data = totals.to_dict()
+        for group, key in (("total", ""), ("auto_code", "S1")):
+            self.assertEqual(data[group][key]["rows"], 4)
+            self.assertEqual(
+                Decimal(data[group][key]["products"]["PCA"]["for_emy"]), expected
+            )
+
+
+class ResultBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(25)
+
+    def amount(self):
+        kind = self.rng.randrange(5)
+        if kind == 0:
+            return self.rng.choice([0, "0", Decimal("0.00"), Decimal("-0.00")])
+        if kind == 1:
+            # 不重新计算时 PCA / HI 为表格中的原值
+            return Decimal(self.rng.uniform(0, 1000))
+        if kind == 2:
+            return Decimal(self.rng.randint(-(10**22), 10**22)).scaleb(-2)
+        return Decimal(self.rng.randint(-(10**6), 10**6)).scaleb(-2)
+
+    def test_columns_round_trip(self):
+        rows = [
+            {
+                "for_com": self.amount(),
+                "for_emy": self.amount(),
+                "formula": self.rng.choice(
+                    [None, "", "0", f"{self.rng.randrange(9)} * 2"]
+                ),
+            }
+            for _ in range(EXAMPLES)
+        ]
+        buffer = ResultBuffer(["for_com", "for_emy", "formula"], ["for_com", "for_emy"])
+        for row in rows:
+            buffer.append(row)
+
+        self.assertEqual(len(buffer), len(rows))
+        for name in ("for_com", "for_emy", "formula"):
+            for value, expected in zip(buffer.column(name), (r[name] for r in rows)):
+                self.assertIs(type(value), type(expected))
+                self.assertEqual(str(value), str(expected))
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class ResultWriterTest(RosterTestCase):
+    def test_empty_cost_cells(self):
+        import pandas as pd
+
+        # 第 3 行的 PCA 保费与第 4 行的 HI 保费为空
+        path = self.edit_roster("empty_cost.xlsx", {(3, 7): None, (4, 19): None})
+        engines = ["openpyxl"] + (["xlsxwriter"] if has_module("xlsxwriter") else [])
+        for engine in engines:
+            output = self.path(f"empty_cost_{engine}.xlsx")
+            self.handler(path, writer=ResultWriter(engine=engine)).handle_excel(output)
+
+            df = pd.read_excel(output)
+            self.assertEqual(len(df), self.rows)
+            self.assertTrue(pd.isnull(df["PCA_for_emy"][0]), engine)
+            self.assertTrue(pd.isnull(df["HI_for_com"][1]), engine)
+            self.assertFalse(df["PCA_for_emy"][1:].isna().any(), engine)
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class WithFormulaTest(RosterTestCase):
+    def results(self, handler: ExcelHandler):
+        active_days, _ = handler.active_days()
+        return handler.handle_rows(handler.input_values(), active_days)
+
+    def test_without_formula(self):
+        import bench
+
+        calculator = CostCalculator(
+            bench.SYNTHETIC_RATES, ExcelHandler.days_of_year, with_formula=False
+        )
+        handler = ExcelHandler(
+            self.roster, auto_map=self.auto_map, calculator=calculator
+        )
+        self.assertFalse(handler.with_formula)
+        for res, expected in zip(self.results(handler), self.results(self.handler())):
+            for name, value in res.items():
+                if name.endswith("_formula"):
+                    self.assertIsNone(value)
+                else:
+                    self.assertEqual(value, expected[name])
+
+    def test_conflicting_calculator(self):
+        with self.assertRaises(ValueError):
+            self.handler(with_formula=False)
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class ValidateTest(RosterTestCase):
+    # {(excel 行号, 列号): 值}, 每行一种问题
+    invalid = {
+        (3, 2): "2021/13/01",
+        (4, 3): "abc",
+        (5, 4): "abc",
+        (6, 7): "x",
+        (7, 19): "y",
+        (8, 5): "XX",
+        (9, 4): None,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.output = cls.path("new.xlsx")
+
+    def setUp(self):
+        self.invalid_roster = self.edit_roster("invalid.xlsx", self.invalid)
+
+    def test_reasons(self):
+        rejected = self.handler(self.invalid_roster).validate()
+        self.assertEqual(
+            [(r["row"], r["value"], r["reason"]) for r in rejected],
+            [
+                (3, "2021/13/01", "bad date"),
+                (4, "abc", "bad date"),
+                (5, "abc", "not a number"),
+                (6, "x", "not a number"),
+                (7, "y", "not a number"),
+                (8, "XX", "unknown auto_code"),
+                (9, None, "not a number"),
+            ],
+        )
+        self.assertEqual(self.handler().validate(), [])
+
+    def test_empty_cost(self):
+        # 保费可以为空, 工资不可以
+        path = self.edit_roster("empty_cost.xlsx", {(3, 7): None, (4, 19): None})
+        for handler_class in (ExcelHandler, StreamingExcelHandler):
+            handler = handler_class(
+                path, auto_map=self.auto_map, calculator=self.calculator
+            )
+            handler.handle_excel(self.output)
+            self.assertEqual(handler.rejected, [])
+
+    def test_invalid_rows(self):
+        for handler_class in (ExcelHandler, StreamingExcelHandler):
+            handler = handler_class(
+                self.invalid_roster, auto_map=self.auto_map, calculator=self.calculator
+            )
+            with self.assertRaisesRegex(ValueError, "Invalid rows"):
+                handler.handle_excel(self.output)
+
+    def test_skip_invalid(self):
+        import pandas as pd
+
+        frames = []
+        for handler_class in (ExcelHandler, StreamingExcelHandler):
+            handler = handler_class(
+                self.invalid_roster,
+                auto_map=self.auto_map,
+                calculator=self.calculator,
+                skip_invalid=True,
+            )
+            handler.handle_excel(self.output)
+            self.assertEqual(len(handler.rejected), len(self.invalid))
+            self.assertEqual(handler.rows, self.rows - len(self.invalid))
+            frames.append((handler.rejected, pd.read_excel(self.output, dtype=str)))
+
+        (rejected, df), (stream_rejected, stream_df) = frames
+        self.assertEqual(rejected, stream_rejected)
+        self.assertEqual(len(df), self.rows - len(self.invalid))
+        pd.testing.assert_frame_equal(df, stream_df)
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class HandleBatchTest(RosterTestCase):
+    def assertSameResults(self, handler: ExcelHandler, rows: list, active_days: list):
+        batch = handler.handle_batch(rows, active_days)
+        for values, days, res in zip(rows, active_days, batch):
+            expected = handler.handle_values(values, days)
+            self.assertEqual(list(res), list(expected))
+            # 比较 repr, 区分 0 / "0" / Decimal("0.00") 与 NaN
+            self.assertEqual(
+                {k: repr(v) for k, v in res.items()},
+                {k: repr(v) for k, v in expected.items()},
+            )
+
+    def test_matches_handle_values(self):
+        rng = random.Random(1)
+        handler = self.handler()
+        active_days, _ = handler.active_days()
+        rows = []
+        for values in handler.input_values():
+            values = list(values)
+            values[3] = rng.choice(
+                [values[3], 0, rng.uniform(0, 10**5), "12345.678", float("nan")]
+            )
+            rows.append(tuple(values))
+
+        days = [rng.choice([d, 0, -d, 1]) for d in active_days]
+        self.assertSameResults(handler, rows, days)
+
+    def test_without_formula(self):
+        import bench
+
+        calculator = CostCalculator(
+            bench.SYNTHETIC_RATES, ExcelHandler.days_of_year, with_formula=False
+        )
+        handler = ExcelHandler(
+            self.roster, auto_map=self.auto_map, calculator=calculator
+        )
+        active_days, _ = handler.active_days()
+        self.assertSameResults(handler, handler.input_values(), active_days)
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class SalarySheetTest(RosterTestCase):
+    def test_salary_sheet(self):
+        import openpyxl
+
+        # 偶数行的员工在终止日期前几天调整工资 (生效日期最晚为 12/28)
+        wb = openpyxl.load_workbook(self.roster)
+        ws = wb.create_sheet("工资变动")
+        ws.append(["客户姓名", "生效日期", "工资"])
+        for i in range(0, self.rows, 2):
+            ws.append([f"员工{i}", "2021/12/29", 100000])
+        path = self.path("salary_sheet.xlsx")
+        wb.save(path)
+
+        before = self.handler(path)
+        after = self.handler(path, salary_sheet="工资变动")
+        rows = after.input_values()
+        active_days, _ = after.active_days()
+        old = before.handle_rows(rows, active_days, chunk_size=7)
+        new = after.handle_rows(rows, active_days, chunk_size=7)
+
+        changed = 0
+        for i, (values, days, a, b) in enumerate(zip(rows, active_days, old, new)):
+            self.assertEqual(b, after.handle_values(values, days))
+            if i % 2:
+                self.assertEqual(a, b)
+                continue
+
+            for pre in ("ADD", "TL"):
+                for key in (f"{pre}_for_com", f"{pre}_for_emy"):
+                    # 不缴纳或费率为 0 时不受工资影响
+                    if a[key] not in (0, "0"):
+                        self.assertNotEqual(a[key], b[key], (values[0], key))
+                        changed += 1
+
+        self.assertGreater(changed, 0)
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class IncrementalTest(RosterTestCase):
+    def run_excel(self, path: str, name: str, store: ResultStore = None):
+        """
+        :return: (增量计算的命中情况, 输出的内容)
+        """
+        handler = self.handler(path)
+        output = self.path(name)
+        handler.handle_excel(output, store=store)
+        with open(output, "rb") as f:
+            return handler.incremental_stats, f.read()
+
+    def test_store(self):
+        store = ResultStore(self.path("results.db"))
+        self.addCleanup(store.conn.close)
+
+        stats, first = self.run_excel(self.roster, "first.csv", store)
+        self.assertEqual(stats, {"hits": 0, "recalculated": self.rows})
+        stats, second = self.run_excel(self.roster, "second.csv", store)
+        self.assertEqual(stats, {"hits": self.rows, "recalculated": 0})
+        self.assertEqual(first, second)
+
+        # 只修改一行的工资或生效日期时, 只重新计算该行, 结果与全部重新计算相同
+        for name, cells in (
+            ("salary.xlsx", {(5, 4): 12345}),
+            ("date.xlsx", {(6, 2): "2021/01/01"}),
+        ):
+            path = self.edit_roster(name, cells)
+            stats, edited = self.run_excel(path, f"{name}.csv", store)
+            self.assertEqual(stats, {"hits": self.rows - 1, "recalculated": 1})
+            _, expected = self.run_excel(path, f"{name}.expected.csv")
+            self.assertEqual(edited, expected)
+            self.assertNotEqual(edited, first)
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class WorkersTest(RosterTestCase):
+    def output(self, name: str, **kwargs) -> bytes:
+        path = self.path(name)
+        self.handler().handle_excel(path, **kwargs)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_worker_copy(self):
+        import pickle
+
+        handler = self.handler(instrument=Instrument(profile=True))
+        with self.assertRaises(TypeError):
+            pickle.dumps(handler.instrument)
+        pickle.dumps(handler.worker_copy())
+
+    def test_workers(self):
+        self.assertEqual(
+            self.output("serial.csv", workers=1),
+            self.output("parallel.csv", workers=2, chunk_size=7),
+        )
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class StreamingTest(RosterTestCase):
+    def test_same_output(self):
+        import pandas as pd
+
+        frames = []
+        for handler_class in (ExcelHandler, StreamingExcelHandler):
+            path = self.path(f"{handler_class.__name__}.xlsx")
+            handler = handler_class(
+                self.roster, auto_map=self.auto_map, calculator=self.calculator
+            )
+            handler.handle_excel(path)
+            self.assertEqual(handler.rows, self.rows)
+            frames.append(pd.read_excel(path, dtype=str))
+
+        pd.testing.assert_frame_equal(*frames)
+
+    def test_blank_row(self):
+        import openpyxl
+        import pandas as pd
+
+        # 第 5 行为空行, 其后第 10 行工资不是数字, 两种方式的行号与输出相同
+        wb = openpyxl.load_workbook(self.roster)
+        ws = wb.worksheets[0]
+        ws.insert_rows(5)
+        ws.cell(10, 4).value = "abc"
+        path = self.path("blank_row.xlsx")
+        wb.save(path)
+
+        frames = []
+        for handler_class in (ExcelHandler, StreamingExcelHandler):
+            handler = handler_class(
+                path,
+                auto_map=self.auto_map,
+                calculator=self.calculator,
+                skip_invalid=True,
+            )
+            output = self.path(f"blank_row_{handler_class.__name__}.xlsx")
+            handler.handle_excel(output)
+            self.assertEqual(
+                [(x["row"], x["value"]) for x in handler.rejected], [(10, "abc")]
+            )
+            self.assertEqual(handler.rows, self.rows - 1)
+            frames.append(pd.read_excel(output, dtype=str))
+
+        pd.testing.assert_frame_equal(*frames)
+
+    def test_xlsx_only(self):
+        with self.assertRaises(ValueError):
+            StreamingExcelHandler(
+                self.roster, auto_map=self.auto_map, calculator=self.calculator
+            ).handle_excel(self.path("new.csv"))
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class AutoMapCacheTest(RosterTestCase):
+    def cached_mtime(self, path: str) -> int:
+        import pickle
+
+        with open(f"{path}.cache", "rb") as f:
+            return pickle.load(f)["mtime"]
+
+    def test_touched(self):
+        import shutil
+
+        path = self.path("auto_touched.xlsx")
+        shutil.copyfile(self.path("auto.xlsx"), path)
+        plans = AutoMapHandler(path=path).auto_map
+
+        # 内容不变, 只有 mtime 变化时使用缓存并更新 mtime
+        mtime = os.stat(path).st_mtime_ns + 10**9
+        os.utime(path, ns=(mtime, mtime))
+        handler = AutoMapHandler(path=path)
+        self.assertEqual(handler.auto_map, plans)
+        self.assertEqual(self.cached_mtime(path), mtime)
+
+
+class OutputPathTest(unittest.TestCase):
+    def test_same_name(self):
+        paths = [os.path.join("in", "a", "x.xlsx"), os.path.join("in", "b", "x.xlsx")]
+        root = common_root(paths)
+        self.assertEqual(
+            [output_path_for(p, "out", root=root) for p in paths],
+            [
+                os.path.join("out", "a", "x_new.xlsx"),
+                os.path.join("out", "b", "x_new.xlsx"),
+            ],
+        )
+
+    def test_same_dir(self):
+        paths = [os.path.join("in", "x.xlsx"), os.path.join("in", "y.xlsx")]
+        root = common_root(paths)
+        self.assertEqual(
+            [output_path_for(p, "out", ".json", "_totals", root) for p in paths],
+            [
+                os.path.join("out", "x_totals.json"),
+                os.path.join("out", "y_totals.json"),
+            ],
+        )
+
+
+@unittest.skipUnless(has_module("pandas"), "pandas is required")
+class CostServiceTest(RosterTestCase):
+    @classmethod
+    def setUpClass(cls):
+        import bench
+
+        super().setUpClass()
+        CostCalculator.write_rates(bench.SYNTHETIC_RATES, cls.path("rates.json"))
+        with open(cls.roster, "rb") as f:
+            cls.body = f.read()
+
+    def service(self, **kwargs) -> CostService:
+        service = CostService(
+            workers=1,
+            auto_path=self.path("auto.xlsx"),
+            rate_card=self.path("rates.json"),
+            **kwargs,
+        )
+        service.startup()
+        self.addCleanup(service.shutdown)
+        return service
+
+    def post(self, service: CostService, messages: list) -> list:
+        """
+        :param messages: 依次由 receive 返回的消息
+        :return: 发送的消息
+        """
+        import asyncio
+
+        scope = {"type": "http", "method": "POST", "path": "/cost", "query_string": b""}
+        received = iter(messages)
+        sent = []
+
+        async def receive():
+            return next(received)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(service(scope, receive, send))
+        return sent
+
+    def upload(self) -> list:
+        # 分两块上传
+        half = len(self.body) // 2
+        return [
+            {"type": "http.request", "body": self.body[:half], "more_body": True},
+            {"type": "http.request", "body": self.body[half:], "more_body": False},
+        ]
+
+    def test_ok(self):
+        sent = self.post(self.service(), self.upload())
+        self.assertEqual(sent[0]["status"], 200)
+        headers = dict(sent[0]["headers"])
+        self.assertEqual(headers[b"x-rows"], str(self.rows).encode())
+        body = b"".join(m["body"] for m in sent[1:])
+        self.assertEqual(len(body), int(headers[b"content-length"]))
+
+    def test_too_large(self):
+        sent = self.post(self.service(max_body=len(self.body) - 1), self.upload())
+        self.assertEqual(sent[0]["status"], 413)
+
+    def test_queue_full(self):
+        import asyncio
+
+        service = self.service(concurrency=1, max_queue=0)
+        # 空闲时不需要排队
+        sent = self.post(service, self.upload())
+        self.assertEqual(sent[0]["status"], 200)
+
+        # 占用唯一的处理名额后, 新请求需要排队, 超过 max_queue
+        asyncio.run(service.semaphore.acquire())
+        sent = self.post(service, self.upload())
+        self.assertEqual(sent[0]["status"], 503)
+        self.assertEqual(service.queued, 0)
+
+    def test_disconnect(self):
+        service = self.service()
+        sent = self.post(service, self.upload()[:1] + [{"type": "http.disconnect"}])
+        self.assertEqual(sent, [])
+        self.assertEqual(service.running, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()